@@ -0,0 +1,289 @@
+import csv
+import hashlib
+import io
+import math
+import random
+import re
+from itertools import islice, zip_longest
+from multiprocessing import Pool
+
+# values treated as NULL, as in csvstat (agate)
+NULL_VALUES = ('', 'na', 'n/a', 'none', 'null', '.')
+# plain decimal numbers only, float() accepts nan, inf and 1_000 too
+NUMBER_RE = re.compile(r'^\s*[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?\s*$')
+
+
+class HyperLogLog(object):
+
+    """Approximate distinct count in ``2 ** precision`` bytes.
+
+    The standard error is about ``1.04 / sqrt(2 ** precision)``, 0.8 %
+    for the default precision.
+    """
+
+    def __init__(self, precision=14):
+        self.precision = precision
+        self.registers = bytearray(2 ** precision)
+
+    def update(self, values):
+        p = self.precision
+        registers = self.registers
+        shift = 64 - p
+        mask = (1 << shift) - 1
+        for value in values:
+            # first 64 bits of md5, blake2b needs Python 3.6
+            h = int.from_bytes(hashlib.md5(
+                value.encode('utf-8')).digest()[:8], 'big')
+            index = h >> shift
+            rank = shift - (h & mask).bit_length() + 1
+            if rank > registers[index]:
+                registers[index] = rank
+
+    def merge(self, other):
+        self.registers = bytearray(
+            max(a, b) for a, b in zip(self.registers, other.registers))
+
+    def count(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / math.fsum(
+            2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)  # linear counting
+        return int(round(estimate))
+
+
+class KLL(object):
+
+    """Approximate quantiles by KLL sketch (Karnin, Lang, Liberty).
+
+    Keeps ``O(k)`` items; the rank error is about ``1.7 / k``.
+    """
+
+    def __init__(self, k=200, c=2.0 / 3.0):
+        self.k = k
+        self.c = c
+        self.compactors = []
+        self.size = 0
+        self.max_size = 0
+        self._grow()
+
+    def _grow(self):
+        self.compactors.append([])
+        self.max_size = sum(
+            self._capacity(h) for h in range(len(self.compactors)))
+
+    def _capacity(self, height):
+        depth = len(self.compactors) - height - 1
+        return int(math.ceil(self.c ** depth * self.k)) + 1
+
+    def _compress(self):
+        for height, items in enumerate(self.compactors):
+            if len(items) >= self._capacity(height):
+                if height + 1 >= len(self.compactors):
+                    self._grow()
+                items.sort()
+                odd = len(items) % 2
+                # every other item is promoted with double weight
+                self.compactors[height + 1].extend(
+                    items[odd + random.randint(0, 1)::2])
+                del items[odd:]
+                self.size = sum(len(c) for c in self.compactors)
+                break
+
+    def update(self, values):
+        level = self.compactors[0]
+        for value in values:
+            level.append(value)
+            self.size += 1
+            if self.size >= self.max_size:
+                self._compress()
+                level = self.compactors[0]
+
+    def merge(self, other):
+        while len(self.compactors) < len(other.compactors):
+            self._grow()
+        for items, other_items in zip(self.compactors, other.compactors):
+            items.extend(other_items)
+        self.size = sum(len(c) for c in self.compactors)
+        while self.size >= self.max_size:
+            self._compress()
+
+    def quantiles(self, fractions):
+        items = sorted(
+            (item, 2 ** height)
+            for height, compactor in enumerate(self.compactors)
+            for item in compactor)
+        total = sum(weight for _, weight in items)
+        result = []
+        for fraction in fractions:
+            if not items:
+                result.append(None)
+                continue
+            rank, target = 0, fraction * total
+            for item, weight in items:
+                rank += weight
+                if rank >= target:
+                    break
+            result.append(item)
+        return result
+
+
+class ColumnStats(object):
+
+    """Statistics of one column updated by chunks of its values."""
+
+    def __init__(self, name, precision=14, k=200):
+        self.name = name
+        self.count = 0
+        self.nulls = 0
+        self.numeric = True
+        self.min = self.max = None
+        self.text_min = self.text_max = None
+        self.sum = 0.0
+        self.distinct = HyperLogLog(precision)
+        self.quantiles = KLL(k)
+
+    def update(self, values):
+        total = len(values)
+        values = [v for v in values if v.strip().lower() not in NULL_VALUES]
+        self.count += total
+        self.nulls += total - len(values)
+        if not values:
+            return
+        self.distinct.update(values)
+        low, high = min(values), max(values)
+        if self.text_min is None or low < self.text_min:
+            self.text_min = low
+        if self.text_max is None or high > self.text_max:
+            self.text_max = high
+
+        if self.numeric:
+            if not all(NUMBER_RE.match(v) for v in values):
+                self.numeric = False
+                self.quantiles = None
+                return
+            numbers = list(map(float, values))
+            low, high = min(numbers), max(numbers)
+            if self.min is None or low < self.min:
+                self.min = low
+            if self.max is None or high > self.max:
+                self.max = high
+            self.sum += math.fsum(numbers)
+            self.quantiles.update(numbers)
+
+    def merge(self, other):
+        self.count += other.count
+        self.nulls += other.nulls
+        self.distinct.merge(other.distinct)
+        for attr, func in [('text_min', min), ('text_max', max),
+                           ('min', min), ('max', max)]:
+            values = [v for v in (getattr(self, attr), getattr(other, attr))
+                      if v is not None]
+            setattr(self, attr, func(values) if values else None)
+        if self.numeric and other.numeric:
+            self.sum += other.sum
+            self.quantiles.merge(other.quantiles)
+        else:
+            self.numeric = False
+            self.quantiles = None
+
+    def result(self, fractions=(0.25, 0.5, 0.75)):
+        values = self.count - self.nulls
+        stats = {
+            'column': self.name,
+            'type': 'Number' if self.numeric and values else 'Text',
+            'count': self.count,
+            'nulls': self.nulls,
+            'distinct': self.distinct.count(),
+        }
+        if stats['type'] == 'Number':
+            stats.update({
+                'min': self.min,
+                'max': self.max,
+                'mean': self.sum / values,
+                'quantiles': dict(zip(
+                    map(str, fractions),
+                    self.quantiles.quantiles(fractions))),
+            })
+        else:
+            stats.update({'min': self.text_min, 'max': self.text_max})
+        return stats
+
+
+class _RangeFile(io.RawIOBase):
+
+    """Raw file object over the ``start:end`` byte range of a file."""
+
+    def __init__(self, path, start, end):
+        self._file = open(path, mode='rb')
+        self._file.seek(start)
+        self._remaining = end - start
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._file.read(min(len(buffer), self._remaining))
+        buffer[:len(data)] = data
+        self._remaining -= len(data)
+        return len(data)
+
+    def close(self):
+        self._file.close()
+        super(_RangeFile, self).close()
+
+
+def collect_stats(path, start=0, end=None, header=None, delimiter=',',
+                  quotechar='"', encoding='utf-8', chunk_size=10000,
+                  precision=14, k=200):
+    """Single pass statistics of the CSV records in ``start:end`` bytes.
+
+    Rows are processed by ``chunk_size`` rows transposed into columns.
+    The header row is read from the file unless ``header`` is given.
+    Returns list of :class:`ColumnStats`.
+    """
+    if end is None:
+        with open(path, mode='rb') as f:
+            end = f.seek(0, io.SEEK_END)
+    raw = io.BufferedReader(_RangeFile(path, start, end), 1024 * 1024)
+    with io.TextIOWrapper(raw, encoding=encoding, newline='') as f:
+        reader = csv.reader(f, delimiter=delimiter, quotechar=quotechar)
+        if header is None:
+            header = next(reader, [])
+        columns = [ColumnStats(name, precision, k) for name in header]
+        while True:
+            chunk = list(islice(reader, chunk_size))
+            if not chunk:
+                break
+            values = zip_longest(*chunk, fillvalue='')
+            for column, column_values in zip(columns, values):
+                column.update(list(column_values))
+    return columns
+
+
+def _collect_range(args):
+    return collect_stats(*args[:-1], **args[-1])
+
+
+def merge_stats(parts):
+    """Merge lists of :class:`ColumnStats` of parts of one file."""
+    columns = parts[0]
+    for part in parts[1:]:
+        for column, other in zip(columns, part):
+            column.merge(other)
+    return columns
+
+
+def collect_stats_parallel(path, ranges, header, processes, **kwargs):
+    """Collect statistics of byte ``ranges`` in ``processes`` processes
+    and merge them."""
+    tasks = [(path, start, end, header, kwargs) for start, end in ranges]
+    pool = Pool(processes)
+    try:
+        parts = pool.map(_collect_range, tasks)
+    finally:
+        pool.close()
+        pool.join()
+    return merge_stats(parts)
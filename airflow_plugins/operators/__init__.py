@@ -1,8 +1,21 @@
 from .base import BashOperator, ExecutableOperator, FileOperator
-from .csv import CSVSQL, CSVLook, CSVStats, CSVtoDB, DBtoCSV, SplitCSVtoDB
+from .csv import (
+    CSVSQL,
+    CSVLook,
+    CSVStats,
+    CSVtoDB,
+    CopyCSVtoDB,
+    CopyDBtoCSV,
+    DBtoCSV,
+    SplitCSVtoDB,
+    UpsertCSVtoDB
+)
 from .db import (
     ChangeDatabaseName,
+    CopyTable,
     CreateDatabase,
+    CreatePartitionedTableWithColumns,
+    CreateTablesWithColumns,
     CreateTableWithColumns,
     DropDatabase,
     PostgresOperator
@@ -23,12 +36,14 @@ from .zip import UnzipOperator, ZipOperator
 
 OPERATORS = [
     BashOperator, ChangeDatabaseName, CreateDatabase,
-    CreateTableWithColumns, CSVLook, CSVSQL, CSVStats, CSVtoDB, DBtoCSV,
+    CreatePartitionedTableWithColumns, CreateTablesWithColumns,
+    CreateTableWithColumns, CSVLook, CSVSQL,
+    CSVStats, CSVtoDB, CopyCSVtoDB, CopyDBtoCSV, CopyTable, DBtoCSV,
     DeferOperator, DeleteFile, DownloadFile,
     DropDatabase, DynamicDeleteFile, DynamicDownloadFile, DynamicUploadFile,
     ExecutableOperator, FileOperator, FileSensor, FTPDirSensor,
     Message, PostgresOperator,
     RunEvaluationOperator,
     SlackMessageSensor, SplitCSVtoDB,
-    TaskRuntimeSensor, UnzipOperator, UploadFile, ZipOperator,
+    TaskRuntimeSensor, UnzipOperator, UploadFile, UpsertCSVtoDB, ZipOperator,
 ]
@@ -1,7 +1,32 @@
+import codecs
+import csv
+import datetime
+import gzip
+import hashlib
+import io
+import json
 import logging
 import os
+import re
+import shutil
+import tempfile
+import time
+import zlib
 
-from airflow_plugins.operators import BashOperator
+from airflow.exceptions import AirflowException
+from airflow.models import BaseOperator
+from airflow.utils.decorators import apply_defaults
+from psycopg2 import sql
+
+from airflow_plugins import csv_stats, utils
+from airflow_plugins.operators import BashOperator, FileOperator
+from airflow_plugins.operators.db import (
+    COPY_BUFFER_SIZE,
+    BinaryCopyEncoder,
+    CreateTableWithColumns,
+    PartitionScheme,
+    PostgresHook
+)
 
 
 class CSVLook(BashOperator):
@@ -37,7 +62,560 @@ class CSVtoDB(BashOperator):
     """  # noqa
 
 
-class DBtoCSV(BashOperator):
+class FileRanges(io.RawIOBase):
+
+    """Read-only file object over byte ranges of a file.
+
+    Reads ``ranges`` (list of ``(start, end)`` offsets) of the file one
+    after another, e.g. the header followed by a chunk of records.
+    """
+
+    def __init__(self, path, ranges):
+        super(FileRanges, self).__init__()
+        self._file = open(path, mode='rb')
+        self._ranges = list(ranges)
+        self._end = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def read(self, size=-1):
+        chunks = []
+        while size != 0:
+            if self._end is None or self._file.tell() >= self._end:
+                if not self._ranges:
+                    break
+                start, self._end = self._ranges.pop(0)
+                self._file.seek(start)
+            remaining = self._end - self._file.tell()
+            if size < 0 or size > remaining:
+                chunk = self._file.read(remaining)
+            else:
+                chunk = self._file.read(size)
+            if not chunk:
+                self._end = None
+                continue
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return b''.join(chunks)
+
+    def close(self):
+        self._file.close()
+        super(FileRanges, self).close()
+
+
+class PostgresCSVMixin(object):
+
+    """PostgresHook for in-process CSV operators.
+
+    Uses ``postgres_conn_id`` or the ``db`` param (connection URI as used
+    by csvsql) together with ``company`` and ``database_name`` params.
+    """
+
+    postgres_conn_id = None
+    pooled = None
+
+    @staticmethod
+    def _get_database_name(params):
+        database_name = params.get('database_name')
+        company = params.get('company')
+        if company:
+            return '{}_{}'.format(company.lower(), database_name)
+        return database_name
+
+    def get_hook(self, params):
+        kwargs = {}
+        if self.postgres_conn_id:
+            kwargs['postgres_conn_id'] = self.postgres_conn_id
+        else:
+            kwargs['uri'] = params.get('db')
+        return PostgresHook(database=self._get_database_name(params),
+                            pooled=self.pooled, **kwargs)
+
+    @staticmethod
+    def _find_record_end(f, pos, quoted=False, quotechar=b'"',
+                         blocksize=1024 * 1024):
+        """Offset behind the first line break at or after ``pos`` which
+        is not enclosed in quotes (``quoted`` is the state at ``pos``)."""
+        f.seek(pos)
+        while True:
+            block = f.read(blocksize)
+            if not block:
+                return pos
+            start = 0
+            while True:
+                end = block.find(b'\n', start)
+                if end == -1:
+                    quoted ^= block.count(quotechar, start) % 2 == 1
+                    break
+                quoted ^= block.count(quotechar, start, end) % 2 == 1
+                start = end + 1
+                if not quoted:
+                    return pos + start
+            pos += len(block)
+
+    @staticmethod
+    def _is_quoted(f, start, end, quoted=False, quotechar=b'"',
+                   blocksize=1024 * 1024):
+        """Quoting state at ``end`` given the state at ``start``."""
+        f.seek(start)
+        while start < end:
+            block = f.read(min(blocksize, end - start))
+            if not block:
+                break
+            quoted ^= block.count(quotechar) % 2 == 1
+            start += len(block)
+        return quoted
+
+    @staticmethod
+    def _get_dialect(params):
+        """csv.reader arguments and encoding from csvkit options in
+        ``params.extra``, overridden by ``delimiter`` and ``encoding``
+        params."""
+        dialect, encoding = CreateTableWithColumns._get_dialect(
+            params.get('extra'))
+        if params.get('delimiter'):
+            dialect['delimiter'] = params['delimiter']
+        if params.get('encoding'):
+            encoding = params['encoding']
+        dialect.setdefault('delimiter', ',')
+        return dialect, encoding
+
+    @staticmethod
+    def _read_header(path, dialect=None, encoding='utf-8'):
+        if codecs.lookup(encoding).name == 'utf-8':
+            encoding = 'utf-8-sig'  # BOM is not part of the first column
+        with open(path, mode='r', encoding=encoding, newline='') as f:
+            return next(csv.reader(f, **(dialect or {})))
+
+    @staticmethod
+    def _pg_encoding(encoding):
+        """PostgreSQL name of the Python encoding."""
+        return CreateTableWithColumns._pg_encoding(encoding)
+
+    @classmethod
+    def _copy_sql(cls, table_name, columns, dialect=None, encoding='utf-8'):
+        # empty values are NULLs even if quoted (as in csvsql)
+        dialect = dialect or {}
+        if not isinstance(table_name, sql.Composable):
+            table_name = sql.SQL(table_name)
+        fields = sql.SQL(', ').join(sql.Identifier(col) for col in columns)
+        return sql.SQL(
+            "COPY {} ({}) FROM STDIN WITH "
+            "(FORMAT csv, HEADER true, DELIMITER {}, QUOTE {}, ENCODING {}, "
+            "FORCE_NULL ({}))"
+        ).format(
+            table_name,
+            fields,
+            sql.Literal(dialect.get('delimiter', ',')),
+            sql.Literal(dialect.get('quotechar', '"')),
+            sql.Literal(cls._pg_encoding(encoding)),
+            fields,
+        )
+
+    @staticmethod
+    def _get_column_types(hook, table_name, columns):
+        """Types of the ``columns`` of the table from the catalog."""
+        types = dict(hook.get_records(
+            "SELECT attname, format_type(atttypid, NULL) FROM pg_attribute "
+            "WHERE attrelid = to_regclass(%s) AND attnum > 0 "
+            "AND NOT attisdropped", parameters=(table_name,)))
+        missing = [col for col in columns if col not in types]
+        if missing:
+            raise AirflowException('Columns {} not found in {}'.format(
+                ', '.join(missing), table_name))
+        return [types[col] for col in columns]
+
+    @staticmethod
+    def _copy_binary_sql(table_name, columns):
+        return sql.SQL("COPY {} ({}) FROM STDIN (FORMAT binary)").format(
+            sql.SQL(table_name),
+            sql.SQL(', ').join(sql.Identifier(col) for col in columns))
+
+    @staticmethod
+    def _encode_binary(f, types, dialect=None, encoding='utf-8'):
+        """Binary COPY stream of the CSV records of the file object,
+        empty values are NULLs as in the CSV COPY."""
+        if codecs.lookup(encoding).name == 'utf-8':
+            encoding = 'utf-8-sig'
+        if not isinstance(f, io.BufferedIOBase):
+            f = io.BufferedReader(f, COPY_BUFFER_SIZE)
+        reader = csv.reader(io.TextIOWrapper(f, encoding=encoding,
+                                             newline=''), **(dialect or {}))
+        next(reader, None)  # header
+        rows = ([value if value != '' else None for value in row]
+                for row in reader)
+        return BinaryCopyEncoder(types, rows)
+
+    @classmethod
+    def _load(cls, hook, params, path, ranges=None, truncate=False,
+              before=None, format='csv'):
+        """COPY CSV file with header into ``params.table_name``.
+        Only given byte ``ranges`` of the file are loaded if set.
+        With ``truncate`` set, the table is emptied in the same
+        transaction first, ``before`` statements run in it as well.
+        With ``format='binary'``, the records are parsed on the client
+        and sent by binary COPY encoded by the column types of the table,
+        see :class:`BinaryCopyEncoder`."""
+        if format not in ('csv', 'binary'):
+            raise ValueError('Unknown COPY format: {}'.format(format))
+        dialect, encoding = cls._get_dialect(params)
+        columns = cls._read_header(path, dialect, encoding)
+        table_name = params.get('table_name', 'import')
+        if format == 'binary':
+            types = cls._get_column_types(hook, table_name, columns)
+            query = cls._copy_binary_sql(table_name, columns)
+        else:
+            query = cls._copy_sql(table_name, columns, dialect, encoding)
+        before = list(before or [])
+        if truncate:
+            before.insert(
+                0, sql.SQL('TRUNCATE {}').format(sql.SQL(table_name)))
+        if ranges is None:
+            f = open(path, mode='rb')
+        else:
+            f = FileRanges(path, ranges)
+        with f:
+            if format == 'binary':
+                return hook.copy(
+                    query, cls._encode_binary(f, types, dialect, encoding),
+                    before=before)
+            return hook.copy(query, f, before=before)
+
+    @staticmethod
+    def _copy_to_sql(query, delimiter=',', header=True):
+        if not isinstance(query, sql.Composable):
+            query = sql.SQL(query.strip().rstrip(';'))
+        return sql.SQL(
+            "COPY ({}) TO STDOUT WITH "
+            "(FORMAT csv, HEADER {}, DELIMITER {})"
+        ).format(
+            query,
+            sql.SQL('true' if header else 'false'),
+            sql.Literal(delimiter),
+        )
+
+    @classmethod
+    def _export(cls, hook, params, path, query=None, compress=False,
+                header=True, before=None):
+        """COPY result of the query (``params.query`` by default)
+        into the file, gzipped if ``compress`` is set. ``before``
+        statements run in the transaction of the COPY first."""
+        query = cls._copy_to_sql(query or params['query'],
+                                 params.get('delimiter', ','), header)
+        if compress:
+            f = gzip.open(path, mode='wb')
+        else:
+            f = open(path, mode='wb')
+        with f:
+            return hook.copy(query, f, before=before)
+
+    @staticmethod
+    def _get_workers(hook, parallel, tasks):
+        """Number of workers capped by free connections of the server."""
+        workers = min(parallel, tasks)
+        try:
+            free = hook.get_free_connections()
+        except Exception as e:
+            logging.warning('Unable to get free connections: {}'.format(e))
+        else:
+            workers = max(1, min(workers, free))
+        return workers
+
+
+class PostgresCSVOperator(PostgresCSVMixin, BaseOperator):
+
+    """Base for in-process CSV operators on PostgresHook."""
+
+    @apply_defaults
+    def __init__(self, postgres_conn_id=None, pooled=None, *args, **kwargs):
+        super(PostgresCSVOperator, self).__init__(*args, **kwargs)
+        self.postgres_conn_id = postgres_conn_id
+        self.pooled = pooled
+
+
+class CopyCSVtoDB(PostgresCSVOperator):
+
+    """Load CSV file into PostgreSQL database using COPY FROM STDIN.
+
+    Accepts the same params as :class:`CSVtoDB`. The file is streamed
+    to the server, so memory use does not depend on the file size.
+    Columns are matched by the CSV header.
+
+    With ``tail`` set, the file is treated as an append-only log: the
+    byte offset behind the last loaded record is stored in the
+    ``checkpoint_table`` of the target database together with a checksum
+    of the header and the ``checksum_size`` bytes before the offset, and
+    the next run loads only the records appended after it (an incomplete
+    last record is left for the next run). When the file got shorter or
+    the checksum does not match, the table is truncated and the whole
+    file is loaded again. The checkpoint is stored in the transaction of
+    the COPY, so it never gets ahead of or behind the loaded rows.
+
+    With ``copy_format='binary'``, the records are sent by binary COPY
+    encoded by the column types of the table, see
+    :meth:`PostgresCSVMixin._load`.
+    """
+
+    _checkpoint_sql = (
+        "CREATE TABLE IF NOT EXISTS {} ("
+        "dag_id text, task_id text, path text, end_offset bigint, "
+        "checksum bigint, loaded_at timestamptz DEFAULT now(), "
+        "PRIMARY KEY (dag_id, task_id, path))")
+
+    @apply_defaults
+    def __init__(self, tail=False, checksum_size=64 * 1024,
+                 checkpoint_table='csv_tail_checkpoints', copy_format='csv',
+                 *args, **kwargs):
+        super(CopyCSVtoDB, self).__init__(*args, **kwargs)
+        self.tail = tail
+        self.checksum_size = checksum_size
+        self.checkpoint_table = checkpoint_table
+        self.copy_format = copy_format
+
+    def _get_tail_checkpoint(self, hook, path):
+        hook.run(self._checkpoint_sql.format(self.checkpoint_table),
+                 autocommit=True)
+        return hook.get_first(sql.SQL(
+            "SELECT end_offset, checksum FROM {} WHERE dag_id = %s "
+            "AND task_id = %s AND path = %s").format(
+                sql.SQL(self.checkpoint_table)),
+            parameters=(self.dag_id, self.task_id, path)) or (None, None)
+
+    def _set_tail_checkpoint_sql(self, path, offset, checksum):
+        return sql.SQL(
+            "INSERT INTO {} (dag_id, task_id, path, end_offset, checksum) "
+            "VALUES ({}) ON CONFLICT (dag_id, task_id, path) DO UPDATE SET "
+            "end_offset = EXCLUDED.end_offset, checksum = EXCLUDED.checksum, "
+            "loaded_at = now()").format(
+                sql.SQL(self.checkpoint_table),
+                sql.SQL(', ').join(map(sql.Literal, [
+                    self.dag_id, self.task_id, path, offset, checksum])))
+
+    def _checksum(self, f, header_end, offset):
+        f.seek(0)
+        checksum = zlib.crc32(f.read(header_end))
+        start = max(header_end, offset - self.checksum_size)
+        f.seek(start)
+        return zlib.crc32(f.read(offset - start), checksum)
+
+    @staticmethod
+    def _find_last_record_end(f, start, end, quotechar=b'"',
+                              blocksize=1024 * 1024):
+        """Offset behind the last line break in ``start:end`` which is not
+        enclosed in quotes, ``start`` if there is none. ``start`` has to be
+        a record boundary, the range is read once."""
+        last, quoted, pos = start, False, start
+        f.seek(start)
+        while pos < end:
+            block = f.read(min(blocksize, end - pos))
+            if not block:
+                break
+            offset = 0
+            while True:
+                newline = block.find(b'\n', offset)
+                if newline == -1:
+                    quoted ^= block.count(quotechar, offset) % 2 == 1
+                    break
+                quoted ^= block.count(quotechar, offset, newline) % 2 == 1
+                offset = newline + 1
+                if not quoted:
+                    last = pos + offset
+            pos += len(block)
+        return last
+
+    def _load_tail(self, hook, params, path):
+        offset, checksum = self._get_tail_checkpoint(hook, path)
+        quotechar = self._get_dialect(params)[0].get('quotechar', '"').encode()
+        with open(path, mode='rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            header_end = self._find_record_end(f, 0, quotechar=quotechar)
+            if (offset is not None and header_end <= offset <= size
+                    and checksum == self._checksum(f, header_end, offset)):
+                start, truncate = offset, False
+            else:
+                logging.info('No matching checkpoint, loading whole file')
+                start, truncate = header_end, True
+            end = self._find_last_record_end(f, start, size, quotechar)
+            checksum = self._checksum(f, header_end, end)
+
+        rows = 0
+        if truncate or end > start:
+            logging.info('Loading bytes {} - {} of {}'.format(
+                start, end, size))
+            rows = self._load(hook, params, path,
+                              [(0, header_end), (start, end)],
+                              truncate=truncate,
+                              before=[self._set_tail_checkpoint_sql(
+                                  path, end, checksum)],
+                              format=self.copy_format)
+        return rows
+
+    def execute(self, context):
+        params = context['params']
+        hook = self.get_hook(params)
+        started_at = time.time()
+        if self.tail:
+            rows = self._load_tail(hook, params, params['local_path'])
+        else:
+            rows = self._load(hook, params, params['local_path'],
+                              format=self.copy_format)
+        logging.info('Loaded {} rows in {:.1f} s'.format(
+            rows, time.time() - started_at))
+
+
+class UpsertCSVtoDB(PostgresCSVOperator):
+
+    """Merge CSV file into existing table by its key columns.
+
+    Accepts the same params as :class:`CSVtoDB`. The file is loaded by
+    COPY into a temporary staging table and merged by
+    INSERT ... ON CONFLICT (key_columns) DO UPDATE, which touches only
+    new and changed rows. Of rows with the same key in the file, the last
+    one is used. With ``delete_missing`` set, rows missing in the
+    file are deleted from the table. Everything runs in one transaction.
+    The table needs unique index on the key columns.
+    """
+
+    @apply_defaults
+    def __init__(self, key_columns, delete_missing=False, *args, **kwargs):
+        super(UpsertCSVtoDB, self).__init__(*args, **kwargs)
+        self.key_columns = key_columns
+        self.delete_missing = delete_missing
+
+    def _merge_sql(self, table_name, staging_name, columns):
+        table = sql.SQL(table_name)
+        staging = sql.Identifier(staging_name)
+        keys = sql.SQL(', ').join(map(sql.Identifier, self.key_columns))
+        values = [col for col in columns if col not in self.key_columns]
+        fields = sql.SQL(', ').join(map(sql.Identifier, columns))
+
+        if values:
+            update = sql.SQL(
+                "DO UPDATE SET ({values}) = ({excluded}) "
+                "WHERE ({current}) IS DISTINCT FROM ({excluded})"
+            ).format(
+                values=sql.SQL(', ').join(map(sql.Identifier, values)),
+                excluded=sql.SQL(', ').join(
+                    sql.SQL('EXCLUDED.{}').format(sql.Identifier(col))
+                    for col in values),
+                current=sql.SQL(', ').join(
+                    sql.SQL('t.{}').format(sql.Identifier(col))
+                    for col in values),
+            )
+            if len(values) == 1:
+                # single column SET does not accept row expression
+                update = sql.SQL(
+                    "DO UPDATE SET {value} = EXCLUDED.{value} "
+                    "WHERE t.{value} IS DISTINCT FROM EXCLUDED.{value}"
+                ).format(value=sql.Identifier(values[0]))
+        else:
+            update = sql.SQL("DO NOTHING")
+
+        # a row can be affected once only, the last one in the file wins
+        merge = sql.SQL(
+            "INSERT INTO {table} AS t ({fields}) "
+            "SELECT DISTINCT ON ({keys}) {fields} FROM {staging} "
+            "ORDER BY {keys}, ctid DESC "
+            "ON CONFLICT ({keys}) {update}"
+        ).format(table=table, fields=fields, staging=staging, keys=keys,
+                 update=update)
+
+        delete = sql.SQL(
+            "DELETE FROM {table} t WHERE NOT EXISTS "
+            "(SELECT 1 FROM {staging} s WHERE {condition})"
+        ).format(
+            table=table, staging=staging,
+            condition=sql.SQL(' AND ').join(
+                sql.SQL('s.{key} = t.{key}').format(key=sql.Identifier(key))
+                for key in self.key_columns),
+        )
+        return merge, delete
+
+    def execute(self, context):
+        params = context['params']
+        dialect, encoding = self._get_dialect(params)
+        path = params['local_path']
+        table_name = params.get('table_name', 'import')
+        staging_name = 'staging_{}'.format(
+            table_name.split('.')[-1].strip('"'))
+        columns = self._read_header(path, dialect, encoding)
+        merge, delete = self._merge_sql(table_name, staging_name, columns)
+
+        hook = self.get_hook(params)
+        conn = hook.get_conn()
+        conn.autocommit = False
+        cur = conn.cursor()
+        started_at = time.time()
+        try:
+            cur.execute(sql.SQL(
+                "CREATE TEMPORARY TABLE {} "
+                "(LIKE {} INCLUDING DEFAULTS) ON COMMIT DROP"
+            ).format(sql.Identifier(staging_name), sql.SQL(table_name)))
+            with open(path, mode='rb') as f:
+                cur.copy_expert(
+                    self._copy_sql(sql.Identifier(staging_name), columns,
+                                   dialect, encoding).as_string(conn),
+                    f, COPY_BUFFER_SIZE)
+            staged = cur.rowcount
+            cur.execute(sql.SQL("ANALYZE {}").format(
+                sql.Identifier(staging_name)))
+            cur.execute(merge)
+            merged = cur.rowcount
+            deleted = 0
+            if self.delete_missing:
+                cur.execute(delete)
+                deleted = cur.rowcount
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+            hook.release_conn(conn)
+
+        logging.info('Staged {} rows, inserted or updated {}, deleted {} '
+                     'in {:.1f} s'.format(staged, merged, deleted,
+                                          time.time() - started_at))
+
+
+class DBtoCSV(PostgresCSVMixin, BashOperator):
+
+    """Use sql2csv tool for export of query result to CSV file.
+
+    With ``cache`` set, the query is not run again when neither the
+    params of the command (rendered query, ``extra`` options and the
+    database; not the output path) nor the change markers of the tables
+    it reads changed since the previous successful run, and the previous
+    output is reused.
+    Change markers are the ``pg_stat_user_tables`` counters of inserted,
+    updated and deleted tuples plus the relation file node (changed by
+    TRUNCATE) of ``cache_tables`` (by default tables after FROM/JOIN of
+    the query) and the result of the ``cache_watermark`` query, e.g.
+    ``SELECT max(updated_at) FROM t``. A table without statistics (a view,
+    a CTE name) disables the cache for the run.
+
+    The output is kept at ``cache_path`` (local path or
+    ``s3://bucket/key``) or at the previous ``output_path_temp`` when it
+    still exists.
+
+    With ``incremental_column`` set, only rows with the column greater
+    than the last watermark are exported. The watermark is read by
+    :class:`ValueResolver` from the ``watermark_key`` variable (per company
+    and dag, ``initial_watermark`` on the first run). The key defaults to
+    ``<task_id>_date`` for date and timestamp columns and to
+    ``<task_id>_watermark`` otherwise. The upper bound of the exported
+    range is selected before the export and stored as the new watermark
+    only after the export succeeded. Timestamp bounds are truncated to
+    seconds and stored in UTC, as ``*_date`` variables have second
+    precision and no time zone.
+    """
 
     bash_command = """
     sql2csv {{ params.extra }} --query "{{ params.query }}" \
@@ -46,45 +624,527 @@ class DBtoCSV(BashOperator):
         {%- endif %} > {{ params.output_path_temp }}
     """  # noqa
 
+    template_fields = BashOperator.template_fields + ('cache_path',)
+
+    _tables_re = re.compile(
+        r'\b(?:FROM|JOIN)\s+((?:"[^"]+"|\w+)(?:\.(?:"[^"]+"|\w+))?)',
+        re.IGNORECASE)
+
+    _command_params = ('query', 'extra', 'db', 'company', 'database_name')
+
+    _markers_sql = (
+        "SELECT t.name, s.n_tup_ins, s.n_tup_upd, s.n_tup_del, "
+        "pg_relation_filenode(s.relid) "
+        "FROM unnest(%s::text[]) WITH ORDINALITY t(name, i) "
+        "LEFT JOIN pg_stat_user_tables s ON s.relid = to_regclass(t.name) "
+        "ORDER BY t.i")
+
+    @apply_defaults
+    def __init__(self, cache=False, cache_tables=None, cache_watermark=None,
+                 cache_path=None, incremental_column=None, watermark_key=None,
+                 initial_watermark=None, postgres_conn_id=None, pooled=None,
+                 *args, **kwargs):
+        super(DBtoCSV, self).__init__(*args, **kwargs)
+        self.cache = cache
+        self.cache_tables = cache_tables
+        self.cache_watermark = cache_watermark
+        self.cache_path = cache_path
+        self.incremental_column = incremental_column
+        self.watermark_key = watermark_key
+        self.initial_watermark = initial_watermark
+        self.postgres_conn_id = postgres_conn_id
+        self.pooled = pooled
+        self._watermark = None
+        self._watermark_key = None
+
+    @property
+    def _cache_variable(self):
+        return 'export_cache_{}_{}'.format(self.dag_id, self.task_id)
+
+    def _get_cache_key(self, params):
+        query = params['query']
+        tables = self.cache_tables or sorted(set(
+            self._tables_re.findall(query)))
+        hook = self.get_hook(params)
+        markers = hook.get_records(self._markers_sql, parameters=(tables,))
+        missing = [m[0] for m in markers if m[1] is None]
+        if missing:
+            logging.info('No statistics for {}, cache disabled'.format(
+                ', '.join(missing)))
+            return None
+
+        watermark = None
+        if self.cache_watermark:
+            watermark = hook.get_first(self.cache_watermark)
+        command = [params.get(name) for name in self._command_params]
+        key = json.dumps([command, markers, watermark], default=str)
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _get_s3(path):
+        from airflow.hooks.S3_hook import S3Hook
+        bucket, key = FileOperator._split_path(path)[1:]
+        return S3Hook('s3.stories.bi'), bucket, key.lstrip('/')
+
+    def _restore(self, state, output_path):
+        path = state.get('path')
+        if not path:
+            return False
+        if path.startswith('s3://'):
+            hook, bucket, key = self._get_s3(path)
+            s3_key = hook.get_bucket(bucket).get_key(key)
+            if s3_key is None:
+                return False
+            s3_key.get_contents_to_filename(output_path)
+            return True
+        if (not os.path.exists(path)
+                or os.path.getsize(path) != state.get('size')):
+            return False
+        if path != output_path:
+            shutil.copyfile(path, output_path)
+        return True
+
+    def _store(self, key, output_path):
+        path = self.cache_path or output_path
+        if path.startswith('s3://'):
+            hook, bucket, s3_key = self._get_s3(path)
+            hook.load_file(output_path, s3_key, bucket, replace=True)
+        elif path != output_path:
+            shutil.copyfile(output_path, path)
+        utils.create_variable(self._cache_variable, json.dumps({
+            'key': key, 'path': path, 'size': os.path.getsize(output_path),
+        }))
+
+    _temporal_types = ('date', 'timestamp without time zone',
+                       'timestamp with time zone')
+
+    def _get_watermark_key(self, column_type):
+        if self.watermark_key:
+            return self.watermark_key
+        return '{}_{}'.format(self.task_id, 'date' if (
+            column_type in self._temporal_types) else 'watermark')
+
+    def _get_watermark(self, params, key, column_type):
+        from airflow_plugins.variables import ValueResolver
+        try:
+            value = ValueResolver.get_value(
+                key, params.get('company'), self.dag_id)
+        except RuntimeError:
+            logging.info('Watermark {} not set, using {}'.format(
+                key, self.initial_watermark))
+            value = self.initial_watermark
+        if (column_type == 'timestamp with time zone'
+                and isinstance(value, datetime.datetime)
+                and value.tzinfo is None):
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return value
+
+    def _set_watermark(self, params, key, value):
+        from airflow_plugins.variables import ValueResolver
+        name = ValueResolver._resolve_names(
+            key, params.get('company'), self.dag_id)[0]
+        if isinstance(value, datetime.datetime):
+            if value.tzinfo is not None:
+                value = (value - value.utcoffset()).replace(tzinfo=None)
+            value = value.strftime('%Y-%m-%dT%H:%M:%S')
+        utils.create_variable(name, str(value))
+        logging.info('Watermark {} advanced to {}'.format(name, value))
+
+    def pre_execute(self, context):
+        super(DBtoCSV, self).pre_execute(context)
+        self._watermark = None
+        if not self.incremental_column:
+            return
+
+        params = context['params']
+        # not quoted, the query is passed in double quotes to sql2csv
+        column = sql.SQL(self.incremental_column)
+        query = sql.SQL(params['query'].strip().rstrip(';'))
+        hook = self.get_hook(params)
+        column_type = hook.get_first(sql.SQL(
+            'SELECT pg_typeof(max({}))::text FROM ({}) q WHERE FALSE').format(
+                column, query))[0]
+        self._watermark_key = self._get_watermark_key(column_type)
+        low = self._get_watermark(params, self._watermark_key, column_type)
+        condition = sql.SQL('TRUE')
+        if low is not None:
+            condition = sql.SQL('{} > {}').format(column, sql.Literal(low))
+        upper = sql.SQL(
+            'date_trunc(\'second\', max({}))'
+            if column_type.startswith('timestamp') else 'max({})').format(
+                column)
+
+        high = hook.get_first(sql.SQL('SELECT {} FROM ({}) q WHERE {}').format(
+            upper, query, condition))[0]
+        if high is None:
+            logging.info('No rows after watermark {}'.format(low))
+            high = low
+        else:
+            self._watermark = high
+        condition = sql.SQL('{} AND {} <= {}').format(
+            condition, column, sql.Literal(high))
+        conn = hook.get_conn()
+        try:
+            params['query'] = sql.SQL('SELECT * FROM ({}) q WHERE {}').format(
+                query, condition).as_string(conn)
+        finally:
+            hook.release_conn(conn)
+        logging.info('Exporting rows from {} to {}'.format(low, high))
+        self.bash_command = self.render_template(
+            'bash_command', type(self).bash_command, context)
+
+    def _execute_cached(self, context):
+        params = context['params']
+        output_path = params['output_path_temp']
+        key = self._get_cache_key(params)
+        if key is not None:
+            state = json.loads(
+                utils.get_variable(self._cache_variable, '{}') or '{}')
+            if state.get('key') == key and self._restore(state, output_path):
+                logging.info('Tables did not change, reused {}'.format(
+                    state['path']))
+                return
+
+        result = super(DBtoCSV, self).execute(context)
+        if key is not None:
+            self._store(key, output_path)
+        return result
+
+    def execute(self, context):
+        if self.cache:
+            result = self._execute_cached(context)
+        else:
+            result = super(DBtoCSV, self).execute(context)
+        if self._watermark is not None:
+            self._set_watermark(context['params'], self._watermark_key,
+                                self._watermark)
+        return result
+
+
+class CopyDBtoCSV(PostgresCSVOperator):
+
+    """Export query result to CSV file using COPY TO STDOUT.
+
+    Accepts the same params as :class:`DBtoCSV`. The result is streamed
+    into ``output_path_temp``, so memory use does not depend on the result
+    size. With ``compress`` set, the file is gzipped on the fly.
+
+    With ``partition_column`` and ``partitions`` set, the result is split
+    into key ranges of the column (``partition_bounds`` computed from
+    ``minmax`` or ``percentile`` of the column) which are exported
+    concurrently over separate connections. The parts are concatenated
+    into the output file or kept as ``<output_path_temp>.<i>`` files with
+    ``multipart`` set. All parts read the same snapshot exported by
+    a coordinating transaction, so they are consistent with each other.
+    """
+
+    @apply_defaults
+    def __init__(self, compress=False, partition_column=None, partitions=1,
+                 partition_bounds='minmax', multipart=False,
+                 *args, **kwargs):
+        super(CopyDBtoCSV, self).__init__(*args, **kwargs)
+        self.compress = compress
+        self.partition_column = partition_column
+        self.partitions = partitions
+        self.partition_bounds = partition_bounds
+        self.multipart = multipart
+
+    @staticmethod
+    def _interpolate(low, high, n):
+        """Split range of numbers or dates into ``n`` intervals."""
+        if isinstance(low, int):
+            return [low + (high - low) * i // n for i in range(n + 1)]
+        return [low + (high - low) * i / n for i in range(n + 1)]
+
+    def _get_bounds(self, hook, query):
+        column = sql.Identifier(self.partition_column)
+        n = self.partitions
+        if self.partition_bounds == 'minmax':
+            bounds_sql = sql.SQL(
+                "SELECT min({column}), max({column}) FROM ({query}) q"
+            ).format(column=column, query=query)
+            low, high = hook.get_first(bounds_sql)
+            if low is None:
+                return []
+            try:
+                bounds = self._interpolate(low, high, n)
+            except TypeError:
+                raise AirflowException(
+                    'Unable to interpolate {} values, use percentile '
+                    'partition bounds'.format(type(low).__name__))
+        elif self.partition_bounds == 'percentile':
+            fractions = [i / n for i in range(n + 1)]
+            bounds_sql = sql.SQL(
+                "SELECT percentile_disc({fractions}::float[]) "
+                "WITHIN GROUP (ORDER BY {column}) FROM ({query}) q"
+            ).format(fractions=sql.Literal(fractions), column=column,
+                     query=query)
+            bounds = hook.get_first(bounds_sql)[0]
+            if bounds is None:
+                return []
+        else:
+            raise AirflowException('Unknown partition bounds: {}'.format(
+                self.partition_bounds))
+        # distinct ascending bounds
+        return sorted(set(bounds))
+
+    def _partition_queries(self, query, bounds):
+        # the first and the last partitions are open, so rows out of
+        # the bounds (computed outside of the exported snapshot) are kept
+        column = sql.Identifier(self.partition_column)
+        queries = []
+        pairs = list(zip(bounds, bounds[1:]))
+        for i, (low, high) in enumerate(pairs):
+            conditions = []
+            if i > 0:
+                conditions.append(sql.SQL("{} >= {}").format(
+                    column, sql.Literal(low)))
+            if i < len(pairs) - 1:
+                conditions.append(sql.SQL("{} < {}").format(
+                    column, sql.Literal(high)))
+            if not conditions:
+                break
+            condition = sql.SQL(' AND ').join(conditions)
+            if i == 0:
+                condition = sql.SQL("{} OR {} IS NULL").format(
+                    condition, column)
+            queries.append(sql.SQL("SELECT * FROM ({}) q WHERE {}").format(
+                query, condition))
+        if not queries:
+            queries.append(query)
+        return queries
+
+    @staticmethod
+    def _snapshot_sql(snapshot):
+        return [
+            sql.SQL("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ"),
+            sql.SQL("SET TRANSACTION SNAPSHOT {}").format(
+                sql.Literal(snapshot)),
+        ]
+
+    def _export_part(self, params, i, query, snapshot=None):
+        path = '{}.{}'.format(params['output_path_temp'], i)
+        started_at = time.time()
+        rows = self._export(self.get_hook(params), params, path, query,
+                            compress=self.compress,
+                            header=self.multipart or i == 0,
+                            before=self._snapshot_sql(snapshot)
+                            if snapshot else None)
+        logging.info('Part {} exported: {} rows in {:.1f} s'.format(
+            i, rows, time.time() - started_at))
+        return rows
+
+    def _export_parallel(self, params):
+        hook = self.get_hook(params)
+        query = sql.SQL(params['query'].strip().rstrip(';'))
+        queries = self._partition_queries(query, self._get_bounds(hook, query))
+        workers = self._get_workers(hook, self.partitions, len(queries))
+        logging.info('Exporting {} partitions by {} workers'.format(
+            len(queries), workers))
+
+        output_path = params['output_path_temp']
+        part_paths = ['{}.{}'.format(output_path, i)
+                      for i in range(len(queries))]
+        keep_parts = False
+        # the snapshot can be imported while its transaction is open
+        conn = hook.get_conn()
+        conn.autocommit = False
+        cur = conn.cursor()
+        try:
+            cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            cur.execute("SELECT pg_export_snapshot()")
+            snapshot = cur.fetchone()[0]
+            logging.info('Exporting snapshot {}'.format(snapshot))
+            rows = utils.run_parallel(
+                self._export_part,
+                [(params, i, q, snapshot) for i, q in enumerate(queries)],
+                workers)
+
+            if self.multipart:
+                keep_parts = True
+            else:
+                with open(output_path, mode='wb') as output:
+                    for part_path in part_paths:
+                        # gzip members can be concatenated as well
+                        with open(part_path, mode='rb') as part:
+                            shutil.copyfileobj(part, output)
+        finally:
+            cur.close()
+            conn.rollback()
+            hook.release_conn(conn)
+            if not keep_parts:
+                for part_path in part_paths:
+                    if os.path.exists(part_path):
+                        os.remove(part_path)
+        return sum(rows)
+
+    def execute(self, context):
+        params = context['params']
+        started_at = time.time()
+        if self.partition_column and self.partitions > 1:
+            rows = self._export_parallel(params)
+        else:
+            rows = self._export(self.get_hook(params), params,
+                                params['output_path_temp'],
+                                compress=self.compress)
+        logging.info('Exported {} rows in {:.1f} s'.format(
+            rows, time.time() - started_at))
+
 
 class CSVStats(BashOperator):
 
     """Get stats of the CSV file
     Use csvstat.
+
+    With ``engine='stream'``, the stats are computed in-process in one
+    pass over the file in bounded memory instead: count, nulls, min, max,
+    mean, approximate distinct count (HyperLogLog) and approximate
+    ``quantiles`` (KLL sketch) of each column, see
+    :mod:`airflow_plugins.csv_stats`. The delimiter, quote character and
+    encoding are taken from csvkit options of ``params.extra`` as in
+    :class:`CopyCSVtoDB`. With ``parallel`` set, record
+    aligned byte ranges of the file are processed by that many processes.
+    The stats are logged and returned (pushed to XCom).
     """
 
     bash_command = """
     csvstat {{ params.extra }} {{ params.path }}
     """
 
+    @apply_defaults
+    def __init__(self, engine='csvstat', parallel=None,
+                 quantiles=(0.25, 0.5, 0.75), chunk_size=10000,
+                 *args, **kwargs):
+        super(CSVStats, self).__init__(*args, **kwargs)
+        self.engine = engine
+        self.parallel = parallel
+        self.quantiles = quantiles
+        self.chunk_size = chunk_size
 
-class SplitCSVtoDB(CSVtoDB):
+    def _collect(self, params):
+        path = params['path']
+        dialect, encoding = PostgresCSVMixin._get_dialect(params)
+        if codecs.lookup(encoding).name == 'utf-8':
+            encoding = 'utf-8-sig'  # BOM is not part of the first column
+        quotechar = dialect.get('quotechar', '"')
+        kwargs = {
+            'delimiter': dialect['delimiter'],
+            'quotechar': quotechar,
+            'encoding': encoding,
+            'chunk_size': self.chunk_size,
+        }
+        if not self.parallel or self.parallel < 2:
+            return csv_stats.collect_stats(path, **kwargs)
+
+        header_end, ranges = SplitCSVtoDB._split_ranges(
+            path, self.parallel, quotechar.encode())
+        with open(path, mode='r', encoding=encoding, newline='') as f:
+            header = next(csv.reader(f, **dialect), [])
+        if not ranges:
+            return [csv_stats.ColumnStats(name) for name in header]
+        return csv_stats.collect_stats_parallel(
+            path, ranges, header, min(self.parallel, len(ranges)), **kwargs)
+
+    def execute(self, context):
+        if self.engine != 'stream':
+            return super(CSVStats, self).execute(context)
+
+        started_at = time.time()
+        stats = [column.result(self.quantiles)
+                 for column in self._collect(context['params'])]
+        for i, column in enumerate(stats, 1):
+            logging.info('{:3}. {}'.format(i, column['column']))
+            for key in ['type', 'count', 'nulls', 'distinct', 'min', 'max',
+                        'mean', 'quantiles']:
+                if key in column:
+                    logging.info('      {}: {}'.format(key, column[key]))
+        logging.info('Stats computed in {:.1f} s'.format(
+            time.time() - started_at))
+        return stats
+
+
+class SplitCSVtoDB(PostgresCSVMixin, CSVtoDB):
 
     """Split CSV and upload to DB.
+
+    The file is split into record aligned byte ranges which are loaded
+    with the header prepended, without writing copies of the file.
+
+    With ``parallel`` set, the splits are loaded by COPY concurrently
+    over at most ``parallel`` connections (capped by the free connections
+    of the server) instead of running csvsql for each split in turn.
+    A file of a single split is loaded by COPY as well, so the values are
+    not converted by csvsql depending on the file size.
+
+    With ``resumable`` set, the splits are loaded by COPY as well and each
+    split records its byte range into the ``checkpoint_table`` of the
+    target database in the same transaction. A retry of the task run
+    skips the splits recorded for the same file, so a failed split does
+    not reload the finished ones.
+
+    With ``partition_column`` set, records are routed by hash or range
+    of the column (``partition_by``, ``partitions``, ``partition_bounds``
+    as in :class:`CreatePartitionedTableWithColumns`) into one file per
+    partition and each file is loaded by COPY directly into its partition
+    of the table, concurrently (``parallel`` connections, one by default).
+
+    With ``copy_format='binary'``, the COPY loads send the records by
+    binary COPY encoded by the column types of the table.
     """
 
-    @staticmethod
-    def _split_file(filepath, n):
-        if n <= 1:
-            return
+    _checkpoint_sql = (
+        "CREATE TABLE IF NOT EXISTS {} ("
+        "dag_id text, task_id text, execution_date timestamptz, "
+        "path text, size bigint, start_offset bigint, end_offset bigint, "
+        "loaded_at timestamptz DEFAULT now(), "
+        "PRIMARY KEY (dag_id, task_id, execution_date, path, size, "
+        "start_offset, end_offset))")
 
-        files = [open('{}.{}'.format(filepath, i), mode='w') for i in range(n)]
+    @apply_defaults
+    def __init__(self, parallel=None, postgres_conn_id=None, pooled=None,
+                 resumable=False, checkpoint_table='split_checkpoints',
+                 partition_column=None, partition_by='hash', partitions=4,
+                 partition_bounds=None, copy_format='csv', *args, **kwargs):
+        super(SplitCSVtoDB, self).__init__(*args, **kwargs)
+        self.parallel = parallel
+        self.postgres_conn_id = postgres_conn_id
+        self.pooled = pooled
+        self.resumable = resumable
+        self.checkpoint_table = checkpoint_table
+        self.partition_column = partition_column
+        self.partition_by = partition_by
+        self.partitions = partitions
+        self.partition_bounds = partition_bounds
+        self.copy_format = copy_format
 
-        with open(filepath, mode='r') as f:
-            line = f.readline()
-            for file in files:
-                # header line
-                file.write(line)
+    @classmethod
+    def _split_ranges(cls, filepath, n, quotechar=b'"'):
+        """Split the file into ``n`` record aligned byte ranges.
 
-            i = 0
-            line = f.readline()
-            while line:
-                files[i].write(line)
-                line = f.readline()
-                i = (i + 1) % n
+        Returns the end offset of the header and the list of ``(start,
+        end)`` ranges of the records. Line breaks in quoted values are
+        kept inside the ranges; the file is read once and not rewritten.
+        """
+        with open(filepath, mode='rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            header_end = cls._find_record_end(f, 0, quotechar=quotechar)
+            bounds = [header_end]
+            pos, quoted = header_end, False
+            for i in range(1, n):
+                target = header_end + (size - header_end) * i // n
+                if target <= pos:
+                    continue
+                quoted = cls._is_quoted(f, pos, target, quoted, quotechar)
+                pos = cls._find_record_end(f, target, quoted, quotechar)
+                quoted = False
+                if pos >= size:
+                    break
+                bounds.append(pos)
+            bounds.append(size)
 
-        for file in files:
-            file.close()
+        ranges = [(start, end) for start, end in zip(bounds, bounds[1:])
+                  if end > start]
+        return header_end, ranges
 
     @staticmethod
     def _determine_splits(filepath):
@@ -95,27 +1155,183 @@ class SplitCSVtoDB(CSVtoDB):
             size, splits if splits > 1 else 'no'))
         return splits
 
-    def pre_execute(self, context):
+    def _split_command(self, filepath):
+        # csvsql reads the split from stdin instead of the file
+        command = self.bash_command.strip()
+        command = command[:command.rindex(filepath)]
+        split_command = ('{{ head -c {header} {path}; '
+                         'tail -c +{start} {path} | head -c {length}; }} '
+                         '| {command} -')
+        return ' && '.join(
+            split_command.format(header=self._header_end, path=filepath,
+                                 start=start + 1, length=end - start,
+                                 command=command)
+            for start, end in self._ranges)
+
+    def _get_checkpoint(self, context):
         filepath = context['params']['local_path']
-        self._splits = self._determine_splits(filepath)
+        return (self.dag_id, self.task_id, context['execution_date'],
+                filepath, os.stat(filepath).st_size)
+
+    def _load_checkpoints(self, context):
+        hook = self.get_hook(context['params'])
+        table = sql.SQL(self.checkpoint_table)
+        hook.run(sql.SQL(self._checkpoint_sql).format(table), autocommit=True)
+        records = hook.get_records(sql.SQL(
+            "SELECT start_offset, end_offset FROM {} WHERE dag_id = %s "
+            "AND task_id = %s AND execution_date = %s AND path = %s "
+            "AND size = %s").format(table),
+            parameters=self._get_checkpoint(context))
+        return set(tuple(r) for r in records)
+
+    def _get_partition_scheme(self, hook, table_name):
+        column_type = hook.get_first(
+            "SELECT format_type(atttypid, NULL) FROM pg_attribute "
+            "WHERE attrelid = to_regclass(%s) AND attname = %s",
+            parameters=(table_name, self.partition_column))
+        if column_type is None:
+            raise AirflowException('Column {} of {} not found'.format(
+                self.partition_column, table_name))
+        return PartitionScheme(self.partition_column, self.partition_by,
+                               self.partitions, self.partition_bounds,
+                               column_type[0])
+
+    def _partition_file(self, params, scheme, directory):
+        """Route records of the file into a CSV file per partition."""
+        dialect, encoding = self._get_dialect(params)
+        paths = [os.path.join(directory, '{}.csv'.format(i))
+                 for i in range(len(scheme.get_names('')))]
+        output_encoding = 'utf-8' if codecs.lookup(
+            encoding).name == 'utf-8-sig' else encoding
+        files = [open(path, mode='w', encoding=output_encoding, newline='')
+                 for path in paths]
+        counts = [0] * len(files)
         try:
-            self._split_file(filepath, self._splits)
-        except Exception as e:
-            self._splits = 0
-            logging.warning('Splitting the input file failed: {}'.format(e))
-            logging.info('Trying to load the whole file.')
-        if self._splits > 1:
-            self.bash_command = 'for i in $(seq 0 {}); do {}.$i; done'.format(
-                self._splits - 1, self.bash_command.strip())
-
-    def post_execute(self, context):
+            writers = [csv.writer(f, **dialect) for f in files]
+            with open(params['local_path'], mode='r', encoding=encoding,
+                      newline='') as f:
+                reader = csv.reader(f, **dialect)
+                header = next(reader)
+                column = header.index(self.partition_column)
+                for writer in writers:
+                    writer.writerow(header)
+                for row in reader:
+                    if column >= len(row):
+                        raise AirflowException(
+                            'Record ending on line {} of {} has no {} '
+                            'column'.format(reader.line_num,
+                                            params['local_path'],
+                                            self.partition_column))
+                    i = scheme.route(row[column] or None)
+                    writers[i].writerow(row)
+                    counts[i] += 1
+        finally:
+            for f in files:
+                f.close()
+        return paths, counts
+
+    def _load_partition(self, params, table_name, path):
+        started_at = time.time()
+        rows = self._load(self.get_hook(params),
+                          dict(params, table_name=table_name), path,
+                          format=self.copy_format)
+        duration = time.time() - started_at
+        logging.info('Partition {} loaded: {} rows in {:.1f} s'.format(
+            table_name, rows, duration))
+        return {'partition': table_name, 'rows': rows, 'duration': duration}
+
+    def _load_partitioned(self, context):
+        params = context['params']
+        hook = self.get_hook(params)
+        table_name = params.get('table_name', 'import')
+        scheme = self._get_partition_scheme(hook, table_name)
+        directory = tempfile.mkdtemp(
+            dir=os.path.dirname(os.path.abspath(params['local_path'])))
+        try:
+            paths, counts = self._partition_file(params, scheme, directory)
+            tasks = [(params, name, path) for name, path, count in zip(
+                scheme.get_names(table_name), paths, counts) if count]
+            if not tasks:
+                return []
+            workers = self._get_workers(hook, self.parallel or 1, len(tasks))
+            logging.info('Loading {} partitions by {} workers'.format(
+                len(tasks), workers))
+            timings = utils.run_parallel(self._load_partition, tasks, workers)
+        finally:
+            shutil.rmtree(directory)
+        context['ti'].xcom_push(key='split_timings', value=timings)
+        return timings
+
+    def pre_execute(self, context):
+        if self.partition_column:
+            return
         filepath = context['params']['local_path']
-        if self._splits > 1:
-            for i in range(self._splits):
-                file = '{}.{}'.format(filepath, i)
-                try:
-                    os.remove(file)
-                except Exception as e:
-                    # it's ok, these are just helper files
-                    logging.warning('Unable to delete file'
-                                    '{}: {}'.format(file, e))
+        self._splits = self._determine_splits(filepath)
+        self._header_end, self._ranges = 0, []
+        self._done = set()
+        copy = self.resumable or self.parallel
+        if self._splits > 1 or copy:
+            quotechar = self._get_dialect(context['params'])[0].get(
+                'quotechar', '"').encode()
+            try:
+                self._header_end, self._ranges = self._split_ranges(
+                    filepath, self._splits, quotechar)
+            except Exception as e:
+                if copy:
+                    raise
+                logging.warning('Splitting the input file failed: '
+                                '{}'.format(e))
+                logging.info('Trying to load the whole file.')
+            self._splits = len(self._ranges)
+        if self.resumable:
+            self._checkpoint = self._get_checkpoint(context)
+            self._done = self._load_checkpoints(context)
+            if self._done:
+                logging.info('Resuming, {} of {} splits loaded'.format(
+                    len(self._done & set(self._ranges)), self._splits))
+        elif self._splits > 1 and not self.parallel:
+            self.bash_command = self._split_command(filepath)
+
+    def _load_split(self, params, i):
+        if self._ranges[i] in self._done:
+            logging.info('Split {} already loaded'.format(i))
+            return {'split': i, 'rows': 0, 'duration': 0, 'skipped': True}
+
+        ranges = [(0, self._header_end), self._ranges[i]]
+        before = None
+        if self.resumable:
+            before = [sql.SQL(
+                "INSERT INTO {} (dag_id, task_id, execution_date, path, "
+                "size, start_offset, end_offset) VALUES ({})").format(
+                    sql.SQL(self.checkpoint_table),
+                    sql.SQL(', ').join(map(sql.Literal, self._checkpoint
+                                           + self._ranges[i])))]
+        started_at = time.time()
+        rows = self._load(self.get_hook(params), params,
+                          params['local_path'], ranges, before=before,
+                          format=self.copy_format)
+        duration = time.time() - started_at
+        logging.info('Split {} loaded: {} rows in {:.1f} s'.format(
+            i, rows, duration))
+        return {'split': i, 'rows': rows, 'duration': duration}
+
+    def _load_parallel(self, context):
+        params = context['params']
+        if not self._splits:
+            return []
+        workers = self._get_workers(self.get_hook(params),
+                                    self.parallel or 1, self._splits)
+        logging.info('Loading {} splits by {} workers'.format(
+            self._splits, workers))
+        timings = utils.run_parallel(
+            self._load_split,
+            [(params, i) for i in range(self._splits)], workers)
+        context['ti'].xcom_push(key='split_timings', value=timings)
+        return timings
+
+    def execute(self, context):
+        if self.partition_column:
+            return self._load_partitioned(context)
+        if self.resumable or self.parallel:
+            return self._load_parallel(context)
+        return super(SplitCSVtoDB, self).execute(context)
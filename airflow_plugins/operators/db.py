@@ -1,55 +1,965 @@
+import codecs
+import csv
+import glob
+import io
 import logging
+import os
 import re
+import struct
+import threading
+import time
+import uuid
+import zlib
+from bisect import bisect_right
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
+from itertools import islice
 
 import psycopg2
 import psycopg2.extensions
+import six
+from psycopg2 import extras, sql as pgsql
+from airflow.exceptions import AirflowException
 from airflow.hooks.postgres_hook import PostgresHook as PostgresHookBase
+from airflow.models import BaseOperator
 from airflow.operators.postgres_operator import \
     PostgresOperator as PostgresOperatorBase
+from airflow.settings import Stats
 from airflow.utils.decorators import apply_defaults
+from airflow_plugins import utils
+from airflow_plugins.operators.base import FileOperator
 from airflow_plugins.operators.base import \
     PostgresOperator as PostgresOperatorStatic
 
 
+SSL_ARGS = ['sslmode', 'sslcert', 'sslkey', 'sslrootcert', 'sslcrl']
+
+COPY_BUFFER_SIZE = 1024 * 1024  # bytes sent to server per COPY message
+
+EXPLAINABLE_RE = re.compile(
+    r'^\s*(SELECT|INSERT|UPDATE|DELETE|WITH|VALUES)\b', re.IGNORECASE)
+MODIFY_NODE_RE = re.compile(r'^\s*(Insert|Update|Delete|Merge) on ')
+CHILD_NODE_RE = re.compile(r'^\s*->')
+ACTUAL_ROWS_RE = re.compile(r'actual time=\S+ rows=(\d+)')
+
+INTEGER_RE = re.compile(r'^[+-]?\d+$')
+NUMERIC_RE = re.compile(r'^[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$')
+LEADING_ZERO_RE = re.compile(r'^[+-]?0\d')  # codes like zip, keep as text
+DATE_RE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+TIMESTAMP_RE = re.compile(
+    r'^\d{4}-\d{2}-\d{2}([ T]\d{2}:\d{2}(:\d{2}(\.\d+)?)?)?$')
+UTC_OFFSET_RE = re.compile(r'\s*(?:(Z)|([+-])(\d{2}):?(\d{2})?)$')
+TABLE_NAME_RE = re.compile(r'^[^\W\d]\w*(\.[^\W\d]\w*)?$')
+
+PGCOPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('!ii', 0, 0)
+PGCOPY_TRAILER = struct.pack('!h', -1)
+PG_EPOCH = datetime(2000, 1, 1)
+PG_EPOCH_DATE = PG_EPOCH.date()
+TRUE_VALUES = ('true', 't', 'yes', 'y', 'on', '1')  # as PostgreSQL boolin
+FALSE_VALUES = ('false', 'f', 'no', 'n', 'off', '0')
+
+HASH_PARTITION_SEED = 0x7A5B22367996DCFD  # as in PostgreSQL partbounds.c
+MASK32 = 0xFFFFFFFF
+MASK64 = 0xFFFFFFFFFFFFFFFF
+
+
+class BinaryCopyEncoder(object):
+
+    """Encode rows into PostgreSQL binary COPY format.
+
+    Supported types are smallint, integer, bigint, real, double precision,
+    boolean, text (varchar), date and timestamp (with or without time
+    zone); ``None`` is encoded as NULL, as well as an empty string of other
+    than text column. Values may be Python objects or strings, e.g. fields
+    of a CSV reader. Boolean strings are read as by PostgreSQL (``t``,
+    ``yes``, ``on``, ``0``, ...), others raise ``ValueError``. UTC offset
+    of timestamp values is ignored, as PostgreSQL does; timestamp with
+    time zone columns accept aware values (or strings with UTC offset)
+    only, as the session time zone is not known on the client. The
+    encoder is also a file object, so it can be passed to
+    ``copy_expert`` directly::
+
+        encoder = BinaryCopyEncoder(['integer', 'text'], rows)
+        cur.copy_expert('COPY t FROM STDIN (FORMAT binary)', encoder)
+    """
+
+    _aliases = {
+        'int2': 'smallint', 'int': 'integer', 'int4': 'integer',
+        'int8': 'bigint', 'float4': 'real', 'float': 'double precision',
+        'float8': 'double precision', 'bool': 'boolean',
+        'varchar': 'text', 'character varying': 'text',
+        'timestamp without time zone': 'timestamp',
+        'timestamp with time zone': 'timestamptz',
+    }
+    _structs = {
+        'smallint': (struct.Struct('!ih'), int),
+        'integer': (struct.Struct('!ii'), int),
+        'bigint': (struct.Struct('!iq'), int),
+        'real': (struct.Struct('!if'), float),
+        'double precision': (struct.Struct('!id'), float),
+    }
+
+    def __init__(self, types, rows=()):
+        self._encoders = [self._get_encoder(t) for t in types]
+        # empty CSV field is NULL unless the column is text
+        self._empty_nulls = [self._get_type(t) != 'text' for t in types]
+        self._row_header = struct.pack('!h', len(self._encoders))
+        self._rows = iter(rows)
+        self._buffer = PGCOPY_HEADER
+        self._done = False
+        self.rowcount = 0
+
+    @classmethod
+    def _get_type(cls, type_name):
+        name = ' '.join(type_name.lower().split())
+        return cls._aliases.get(name, name)
+
+    @classmethod
+    def _get_encoder(cls, type_name):
+        name = cls._get_type(type_name)
+        length = struct.Struct('!i')
+
+        if name in cls._structs:
+            packer, convert = cls._structs[name]
+            size = packer.size - 4
+            return lambda v: packer.pack(size, convert(v))
+        if name == 'boolean':
+            return lambda v: b'\x00\x00\x00\x01' + (
+                b'\x01' if cls._to_bool(v) else b'\x00')
+        if name == 'date':
+            return lambda v: length.pack(4) + struct.pack(
+                '!i', (cls._to_date(v) - PG_EPOCH_DATE).days)
+        if name in ('timestamp', 'timestamptz'):
+            aware = name == 'timestamptz'
+            return lambda v: length.pack(8) + struct.pack(
+                '!q', cls._to_microseconds(v, aware))
+        if name == 'text':
+            def encode_text(v):
+                if not isinstance(v, bytes):
+                    v = six.text_type(v).encode('utf-8')
+                return length.pack(len(v)) + v
+            return encode_text
+        raise ValueError('Type {} is not supported in binary COPY'.format(
+            type_name))
+
+    @staticmethod
+    def _to_bool(value):
+        if not isinstance(value, six.string_types):
+            return bool(value)
+        text = value.strip().lower()
+        if text in TRUE_VALUES:
+            return True
+        if text in FALSE_VALUES:
+            return False
+        raise ValueError('Invalid boolean value {!r}'.format(value))
+
+    @staticmethod
+    def _to_date(value):
+        if isinstance(value, six.string_types):
+            return datetime.strptime(value[:10], '%Y-%m-%d').date()
+        if isinstance(value, datetime):
+            return value.date()
+        return value
+
+    @staticmethod
+    def _to_datetime(value):
+        """Datetime of the value, aware if the string has UTC offset."""
+        if not isinstance(value, six.string_types):
+            if not isinstance(value, datetime):
+                value = datetime(value.year, value.month, value.day)
+            return value
+        date_part, _, time_part = value.strip().replace('T', ' ').partition(
+            ' ')
+        tzinfo = None
+        match = UTC_OFFSET_RE.search(time_part)
+        if match and time_part[:match.start()]:
+            _, sign, hours, minutes = match.groups()
+            offset = timedelta(hours=int(hours or 0),
+                               minutes=int(minutes or 0))
+            tzinfo = timezone(-offset if sign == '-' else offset)
+            time_part = time_part[:match.start()]
+        value = ' '.join(part for part in (date_part, time_part) if part)
+        fmt = '%Y-%m-%d %H:%M:%S.%f' if '.' in value else (
+            '%Y-%m-%d %H:%M:%S' if value.count(':') == 2 else (
+                '%Y-%m-%d %H:%M' if ':' in value else '%Y-%m-%d'))
+        return datetime.strptime(value, fmt).replace(tzinfo=tzinfo)
+
+    @classmethod
+    def _to_microseconds(cls, value, aware=False):
+        """Microseconds since the PostgreSQL epoch. With ``aware`` set
+        (timestamp with time zone) the value is converted to UTC and naive
+        values are rejected, otherwise UTC offset is dropped."""
+        value = cls._to_datetime(value)
+        if value.tzinfo is None:
+            if aware:
+                raise ValueError(
+                    'Value {} of timestamp with time zone has no UTC '
+                    'offset'.format(value))
+        elif aware:
+            value = (value - value.utcoffset()).replace(tzinfo=None)
+        else:
+            value = value.replace(tzinfo=None)
+        delta = value - PG_EPOCH
+        return ((delta.days * 86400 + delta.seconds) * 1000000
+                + delta.microseconds)
+
+    def encode_row(self, row):
+        """Encode one row (without the file header)."""
+        return self._row_header + b''.join(
+            b'\xff\xff\xff\xff'
+            if value is None or (empty_null and value == '')
+            else encode(value)
+            for encode, empty_null, value
+            in zip(self._encoders, self._empty_nulls, row))
+
+    def read(self, size=COPY_BUFFER_SIZE):
+        """Return next ``size`` bytes of the encoded stream."""
+        chunks = [self._buffer]
+        length = len(self._buffer)
+        while length < size and not self._done:
+            try:
+                row = next(self._rows)
+            except StopIteration:
+                self._done = True
+                chunks.append(PGCOPY_TRAILER)
+                break
+            data = self.encode_row(row)
+            chunks.append(data)
+            length += len(data)
+            self.rowcount += 1
+        data = b''.join(chunks)
+        self._buffer = data[size:]
+        return data[:size]
+
+
+def _rot(x, k):
+    return ((x << k) | (x >> (32 - k))) & MASK32
+
+
+def _mix(a, b, c):
+    a = (a - c) & MASK32 ^ _rot(c, 4)
+    c = (c + b) & MASK32
+    b = (b - a) & MASK32 ^ _rot(a, 6)
+    a = (a + c) & MASK32
+    c = (c - b) & MASK32 ^ _rot(b, 8)
+    b = (b + a) & MASK32
+    a = (a - c) & MASK32 ^ _rot(c, 16)
+    c = (c + b) & MASK32
+    b = (b - a) & MASK32 ^ _rot(a, 19)
+    a = (a + c) & MASK32
+    c = (c - b) & MASK32 ^ _rot(b, 4)
+    b = (b + a) & MASK32
+    return a, b, c
+
+
+def _final(a, b, c):
+    c = ((c ^ b) - _rot(b, 14)) & MASK32
+    a = ((a ^ c) - _rot(c, 11)) & MASK32
+    b = ((b ^ a) - _rot(a, 25)) & MASK32
+    c = ((c ^ b) - _rot(b, 16)) & MASK32
+    a = ((a ^ c) - _rot(c, 4)) & MASK32
+    b = ((b ^ a) - _rot(a, 14)) & MASK32
+    c = ((c ^ b) - _rot(b, 24)) & MASK32
+    return a, b, c
+
+
+def _hash_init(length, seed):
+    a = b = c = (0x9e3779b9 + length + 3923095) & MASK32
+    if seed:
+        a = (a + (seed >> 32)) & MASK32
+        b = (b + (seed & MASK32)) & MASK32
+        a, b, c = _mix(a, b, c)
+    return a, b, c
+
+
+def pg_hash_uint32(value, seed=0):
+    """PostgreSQL ``hash_bytes_uint32_extended`` (Jenkins lookup3)."""
+    a, b, c = _hash_init(4, seed)
+    a, b, c = _final((a + (value & MASK32)) & MASK32, b, c)
+    return (b << 32) | c
+
+
+def pg_hash_bytes(data, seed=0):
+    """PostgreSQL ``hash_bytes_extended`` (Jenkins lookup3)."""
+    a, b, c = _hash_init(len(data), seed)
+    pos = 0
+    while len(data) - pos >= 12:
+        ka, kb, kc = struct.unpack_from('<3I', data, pos)
+        a, b, c = _mix((a + ka) & MASK32, (b + kb) & MASK32,
+                       (c + kc) & MASK32)
+        pos += 12
+    # the lowest byte of c is reserved for the length
+    ka, kb, kc = struct.unpack('<3I', data[pos:].ljust(12, b'\x00'))
+    a, b, c = _final((a + ka) & MASK32, (b + kb) & MASK32,
+                     (c + (kc << 8)) & MASK32)
+    return (b << 32) | c
+
+
+class PartitionScheme(object):
+
+    """Declarative partitioning of a table by one column.
+
+    ``hash`` partitioning creates ``partitions`` partitions ``<table>_p<i>``
+    with remainders ``i``; rows are routed the same way as PostgreSQL
+    does for integer, text and date columns. ``range`` partitioning
+    creates a partition for each interval between sorted ``bounds``
+    (from MINVALUE to MAXVALUE) and a ``<table>_default`` partition
+    for NULLs. Numeric, date and timestamp bounds are compared as values
+    of their type, others as strings (fine for ISO dates, text needs "C"
+    collation).
+    """
+
+    _int_types = ('smallint', 'integer', 'bigint')
+
+    def __init__(self, column, partition_by='hash', partitions=4,
+                 bounds=None, column_type='text'):
+        if partition_by not in ('hash', 'range'):
+            raise ValueError('Unknown partitioning: {}'.format(partition_by))
+        if partition_by == 'range' and not bounds:
+            raise ValueError('Range partitioning needs bounds')
+        self.column = column
+        self.partition_by = partition_by
+        self.partitions = partitions
+        self.bounds = sorted(bounds or [])
+        self.column_type = column_type.lower()
+
+    @property
+    def key_sql(self):
+        return '{} ({})'.format(self.partition_by.upper(), self.column)
+
+    def get_names(self, table):
+        if self.partition_by == 'hash':
+            count = self.partitions
+        else:
+            count = len(self.bounds) + 1
+        names = ['{}_p{}'.format(table, i) for i in range(count)]
+        if self.partition_by == 'range':
+            names.append('{}_default'.format(table))
+        return names
+
+    @staticmethod
+    def _literal(value):
+        if isinstance(value, six.integer_types):
+            return str(value)
+        return "'{}'".format(str(value).replace("'", "''"))
+
+    def get_create_sql(self, table):
+        """CREATE statements of the partitions of the table."""
+        names = self.get_names(table)
+        if self.partition_by == 'hash':
+            return [
+                'CREATE TABLE {} PARTITION OF {} FOR VALUES WITH '
+                '(MODULUS {}, REMAINDER {});'.format(
+                    name, table, self.partitions, i)
+                for i, name in enumerate(names)
+            ]
+        bounds = ['MINVALUE'] + [self._literal(b) for b in self.bounds] + [
+            'MAXVALUE']
+        statements = [
+            'CREATE TABLE {} PARTITION OF {} FOR VALUES '
+            'FROM ({}) TO ({});'.format(name, table, low, high)
+            for name, low, high in zip(names, bounds, bounds[1:])
+        ]
+        statements.append('CREATE TABLE {} PARTITION OF {} DEFAULT;'.format(
+            names[-1], table))
+        return statements
+
+    def _hash(self, value):
+        if self.column_type in self._int_types:
+            value = int(value)
+            low, high = value & MASK32, (value >> 32) & MASK32
+            return pg_hash_uint32(
+                low ^ (high if value >= 0 else ~high & MASK32),
+                HASH_PARTITION_SEED)
+        if self.column_type == 'date':
+            days = (datetime.strptime(value, '%Y-%m-%d').date()
+                    - PG_EPOCH_DATE).days
+            return pg_hash_uint32(days, HASH_PARTITION_SEED)
+        if self.column_type in ('text', 'character varying'):
+            return pg_hash_bytes(value.encode('utf-8'), HASH_PARTITION_SEED)
+        raise ValueError('Hash partitioning by {} is not supported'.format(
+            self.column_type))
+
+    def route(self, value):
+        """Index of the partition for the value (``None`` is NULL)."""
+        if self.partition_by == 'hash':
+            row_hash = 0
+            if value is not None:
+                # hash_combine64 of the single key column
+                row_hash = (self._hash(value) + 0x49a0f4dd15e5a8e3) & MASK64
+            return row_hash % self.partitions
+        if value is None:
+            return len(self.bounds) + 1
+        return bisect_right(self.bounds, self._convert(value))
+
+    def _convert(self, value):
+        """Value of the type of the bounds."""
+        bound = self.bounds[0]
+        if isinstance(bound, six.string_types) or isinstance(bound, bool):
+            return value
+        if isinstance(bound, datetime):
+            return BinaryCopyEncoder._to_datetime(value)
+        if isinstance(bound, date):
+            return BinaryCopyEncoder._to_date(value)
+        if all(isinstance(b, six.integer_types) for b in self.bounds):
+            return int(value)
+        return Decimal(value)  # compares exactly with floats and ints
+
+
+class ConnectionPool(object):
+
+    """Process-wide pool of idle psycopg2 connections.
+
+    Connections are kept per key (conn_id, database, ssl args). At most
+    ``max_size`` idle connections are kept per key, connections idle for
+    longer than ``idle_timeout`` seconds are closed and connections idle
+    for longer than ``check_after`` seconds are checked with ``SELECT 1``
+    before they are handed out again.
+    """
+
+    def __init__(self, max_size=4, idle_timeout=300, check_after=30):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.check_after = check_after
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        # connections must not be shared with forked workers
+        self._pid = os.getpid()
+        self._idle = {}
+
+    def _is_healthy(self, conn, idle_for):
+        if conn.closed:
+            return False
+        if idle_for < self.check_after:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT 1;')
+            cur.close()
+            conn.rollback()
+        except Exception as e:
+            logging.info('Dropping broken pooled connection: {}'.format(e))
+            return False
+        return True
+
+    def get(self, key, connect):
+        """Borrow connection for the key or open a new one by ``connect``."""
+        while True:
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._reset()
+                idle = self._idle.get(key)
+                if not idle:
+                    break
+                conn, released_at = idle.pop()
+
+            idle_for = time.time() - released_at
+            if idle_for < self.idle_timeout and self._is_healthy(conn,
+                                                                 idle_for):
+                return conn
+            self._close(conn)
+
+        return connect()
+
+    def put(self, key, conn):
+        """Return borrowed connection back to the pool. Session state
+        (settings, role, temporary tables, prepared statements) is reset
+        by DISCARD ALL, so it does not leak to the next borrower."""
+        if conn.closed:
+            return
+        try:
+            if (conn.get_transaction_status() !=
+                    psycopg2.extensions.TRANSACTION_STATUS_IDLE):
+                conn.rollback()
+            conn.autocommit = True  # DISCARD ALL can't run in transaction
+            cur = conn.cursor()
+            cur.execute('DISCARD ALL;')
+            cur.close()
+            conn.autocommit = False
+        except Exception as e:
+            logging.info('Dropping pooled connection: {}'.format(e))
+            self._close(conn)
+            return
+
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            idle = self._idle.setdefault(key, deque())
+            if len(idle) < self.max_size:
+                idle.append((conn, time.time()))
+                return
+        self._close(conn)
+
+    def clear(self):
+        """Close all idle connections."""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for conn, _ in connections:
+                self._close(conn)
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+pool = ConnectionPool()
+
+
 class PostgresHook(PostgresHookBase):
 
     """Tuned PostgreSQL hook which support
     running SQL like create database.
     Supports silent fail.
+
+    Connections are borrowed from the process-wide :data:`pool` when
+    ``pooled`` is set or when the connection extra contains
+    ``"pool": true``.
+
+    The connection can be given as ``uri`` (e.g. the ``db`` param of the
+    csvkit based operators) instead of a ``postgres_conn_id``.
+
+    With ``batch`` set, :meth:`run` executes all statements in a single
+    transaction.
+
+    With ``instrument`` set, :meth:`run` records duration, rowcount and
+    plan of each statement into ``statement_stats`` and sends the timings
+    to Stats. ``explain`` is either ``'plan'`` (EXPLAIN slow statements
+    after they run) or ``'analyze'`` (run statements through EXPLAIN
+    (ANALYZE, BUFFERS)). Statements running ``slow_threshold`` seconds
+    or longer are logged with their plans.
     """
 
-    def __init__(self, database=None, fail_silently=False, *args, **kwargs):
+    def __init__(self, database=None, fail_silently=False, pooled=None,
+                 uri=None, batch=False, instrument=False, explain=None,
+                 slow_threshold=None, *args, **kwargs):
         super(PostgresHook, self).__init__(*args, **kwargs)
         self.fail_silently = fail_silently
         self.schema = database
+        self.pooled = pooled
+        self.uri = uri
+        self.batch = batch
+        self.instrument = instrument
+        self.explain = explain
+        self.slow_threshold = slow_threshold
+        self.statement_stats = []
+        self._pool_keys = {}
+        self._conn_args = None
+
+    def get_connection(self, conn_id):
+        if self.uri:
+            from airflow.models import Connection
+            return Connection(conn_id=conn_id, uri=self.uri)
+        return super(PostgresHook, self).get_connection(conn_id)
+
+    def _get_conn_args(self):
+        """psycopg2.connect arguments and whether to pool the connection,
+        resolved from the connection once per hook."""
+        if self._conn_args is None:
+            conn = self.get_connection(self.postgres_conn_id)
+            conn_args = dict(
+                host=conn.host,
+                user=conn.login,
+                password=conn.password,
+                dbname=self.schema or conn.schema,
+                port=conn.port)
+            # check for ssl parameters in conn.extra
+            for arg_name, arg_val in conn.extra_dejson.items():
+                if arg_name in SSL_ARGS:
+                    conn_args[arg_name] = arg_val
+
+            pooled = self.pooled
+            if pooled is None:
+                pooled = conn.extra_dejson.get('pool', False)
+            self._conn_args = conn_args, pooled
+        return self._conn_args
 
     def get_conn(self):
-        conn = self.get_connection(self.postgres_conn_id)
-        conn_args = dict(
-            host=conn.host,
-            user=conn.login,
-            password=conn.password,
-            dbname=self.schema or conn.schema,
-            port=conn.port)
-        # check for ssl parameters in conn.extra
-        for arg_name, arg_val in conn.extra_dejson.items():
-            if arg_name in ['sslmode', 'sslcert', 'sslkey',
-                            'sslrootcert', 'sslcrl']:
-                conn_args[arg_name] = arg_val
-        psycopg2_conn = psycopg2.connect(**conn_args)
+        conn_args, pooled = self._get_conn_args()
+        if pooled:
+            key = (self.uri or self.postgres_conn_id, conn_args['dbname'],
+                   tuple((arg, conn_args.get(arg)) for arg in SSL_ARGS))
+            psycopg2_conn = pool.get(
+                key, lambda: psycopg2.connect(**conn_args))
+            self._pool_keys[id(psycopg2_conn)] = key
+        else:
+            psycopg2_conn = psycopg2.connect(**conn_args)
+
         if psycopg2_conn.server_version < 70400:
             self.supports_autocommit = True
         return psycopg2_conn
 
+    def release_conn(self, conn):
+        """Return connection to the pool or close it if not pooled."""
+        key = self._pool_keys.pop(id(conn), None)
+        if key is not None:
+            pool.put(key, conn)
+        else:
+            conn.close()
+
+    @staticmethod
+    def _as_string(sql, conn):
+        # render psycopg2.sql composed statements
+        if isinstance(sql, str):
+            return sql
+        return sql.as_string(conn)
+
+    def get_records(self, sql, parameters=None):
+        conn = self.get_conn()
+        cur = conn.cursor()
+        try:
+            cur.execute(self._as_string(sql, conn), parameters)
+            return cur.fetchall()
+        finally:
+            cur.close()
+            self.release_conn(conn)
+
+    def get_first(self, sql, parameters=None):
+        conn = self.get_conn()
+        cur = conn.cursor()
+        try:
+            cur.execute(self._as_string(sql, conn), parameters)
+            return cur.fetchone()
+        finally:
+            cur.close()
+            self.release_conn(conn)
+
+    @contextmanager
+    def _iter_cursor(self, sql, parameters=None, itersize=2000):
+        conn = self.get_conn()
+        self.set_autocommit(conn, False)  # named cursors need transaction
+        cur = conn.cursor(name='iter_{}'.format(uuid.uuid4().hex))
+        cur.itersize = itersize
+        try:
+            cur.execute(self._as_string(sql, conn), parameters)
+            yield cur
+        finally:
+            cur.close()
+            conn.rollback()
+            self.release_conn(conn)
+
+    def iter_records(self, sql, parameters=None, itersize=2000):
+        """
+        Yields rows of the query one by one. Rows are fetched from
+        a server-side cursor by ``itersize``, so memory use does not
+        depend on the size of the result.
+
+        The cursor, its transaction and the connection are released when
+        the generator is exhausted or closed. Wrap it in
+        ``contextlib.closing`` when the loop may stop early::
+
+            with closing(hook.iter_records(sql)) as rows:
+                for row in rows:
+                    if done(row):
+                        break
+
+        :param sql: the sql statement to be executed
+        :type sql: str or psycopg2.sql.Composable
+        :param parameters: The parameters to render the SQL query with.
+        :type parameters: mapping or iterable
+        :param itersize: number of rows fetched in one round trip
+        :type itersize: int
+        """
+        with self._iter_cursor(sql, parameters, itersize) as cur:
+            for row in cur:
+                yield row
+
+    def iter_batches(self, sql, parameters=None, batch_size=10000,
+                     columns=False):
+        """
+        Yields rows of the query in lists of ``batch_size`` rows fetched
+        from a server-side cursor. With ``columns`` set, each batch is
+        a dict of column name to list of values instead. Use
+        ``contextlib.closing`` to stop early, as with :meth:`iter_records`.
+
+        :param sql: the sql statement to be executed
+        :type sql: str or psycopg2.sql.Composable
+        :param parameters: The parameters to render the SQL query with.
+        :type parameters: mapping or iterable
+        :param batch_size: number of rows in one batch
+        :type batch_size: int
+        :param columns: yield column-oriented batches
+        :type columns: bool
+        """
+        with self._iter_cursor(sql, parameters, batch_size) as cur:
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                if columns:
+                    names = [col[0] for col in cur.description]
+                    yield dict(zip(names, map(list, zip(*rows))))
+                else:
+                    yield rows
+
+    def insert_rows(self, table, rows, target_fields=None, commit_every=10000,
+                    page_size=1000, method='values'):
+        """
+        Inserts rows by multi-row statements built by ``execute_values``
+        (or ``execute_batch`` with ``method='batch'``). Rows are consumed
+        from the iterable by ``commit_every`` rows which are committed
+        together, so memory stays flat for iterators.
+
+        :param table: name of the target table
+        :type table: str
+        :param rows: rows to insert
+        :type rows: iterable of tuples
+        :param target_fields: names of the columns to fill
+        :type target_fields: iterable of str
+        :param commit_every: number of rows committed at once
+        :type commit_every: int
+        :param page_size: number of rows sent in one statement
+        :type page_size: int
+        :param method: ``'values'`` or ``'batch'``
+        :type method: str
+        :return: number of inserted rows
+        """
+        if method not in ('values', 'batch'):
+            raise ValueError('Unknown insert method: {}'.format(method))
+        rows = iter(rows)
+        columns = pgsql.SQL('')
+        if target_fields:
+            columns = pgsql.SQL(' ({})').format(pgsql.SQL(', ').join(
+                pgsql.Identifier(field) for field in target_fields))
+
+        conn = self.get_conn()
+        self.set_autocommit(conn, False)
+        cur = conn.cursor()
+        total = 0
+        started_at = time.time()
+        try:
+            while True:
+                chunk = list(islice(rows, commit_every))
+                if not chunk:
+                    break
+                if method == 'batch':
+                    values = ', '.join(['%s'] * len(chunk[0]))
+                    query = pgsql.SQL('INSERT INTO {}{} VALUES ({})').format(
+                        pgsql.SQL(table), columns, pgsql.SQL(values))
+                    extras.execute_batch(cur, query.as_string(conn), chunk,
+                                         page_size=page_size)
+                else:
+                    query = pgsql.SQL('INSERT INTO {}{} VALUES %s').format(
+                        pgsql.SQL(table), columns)
+                    extras.execute_values(cur, query.as_string(conn), chunk,
+                                          page_size=page_size)
+                conn.commit()
+                total += len(chunk)
+                logging.info('Loaded {} rows into {}'.format(total, table))
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+            self.release_conn(conn)
+
+        duration = time.time() - started_at
+        logging.info('Inserted {} rows in {:.1f} s ({:.0f} rows/s)'.format(
+            total, duration, total / duration if duration else total))
+        return total
+
+    def copy_rows(self, table, rows, types, target_fields=None):
+        """
+        Loads rows by ``COPY ... FROM STDIN (FORMAT binary)``. The rows are
+        encoded on the client, so the server does not parse any text.
+
+        :param table: name of the target table
+        :type table: str
+        :param rows: rows to load
+        :type rows: iterable of tuples
+        :param types: column types of the rows, see ``BinaryCopyEncoder``
+        :type types: list of str
+        :param target_fields: names of the columns to fill
+        :type target_fields: iterable of str
+        :return: number of loaded rows
+        """
+        columns = pgsql.SQL('')
+        if target_fields:
+            columns = pgsql.SQL(' ({})').format(pgsql.SQL(', ').join(
+                pgsql.Identifier(field) for field in target_fields))
+        query = pgsql.SQL('COPY {}{} FROM STDIN (FORMAT binary)').format(
+            pgsql.SQL(table), columns)
+        return self.copy(query, BinaryCopyEncoder(types, rows))
+
+    def get_free_connections(self):
+        """Number of connections which can still be opened to the server."""
+        return self.get_first(
+            "SELECT current_setting('max_connections')::int "
+            "- current_setting('superuser_reserved_connections')::int "
+            "- count(*) FROM pg_stat_activity;")[0]
+
+    def copy(self, sql, file, size=COPY_BUFFER_SIZE, before=None):
+        """
+        Runs COPY ... FROM STDIN / COPY ... TO STDOUT statement
+        with the file object in a single transaction. The file is streamed
+        by ``size`` bytes, so memory use does not depend on the file size.
+
+        :param sql: the COPY statement
+        :type sql: str or psycopg2.sql.Composable
+        :param file: file-like object to read from or to write to
+        :param size: size of the buffer used for reading the file
+        :type size: int
+        :param before: statements run in the same transaction before COPY
+        :type before: list of str or psycopg2.sql.Composable
+        :return: number of copied rows
+        """
+        conn = self.get_conn()
+        sql = self._as_string(sql, conn)
+        cur = conn.cursor()
+        try:
+            for statement in before or []:
+                statement = self._as_string(statement, conn)
+                logging.info(statement)
+                cur.execute(statement)
+            logging.info(sql)
+            cur.copy_expert(sql, file, size)
+            conn.commit()
+            rowcount = cur.rowcount
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+            self.release_conn(conn)
+
+        return rowcount
+
+    @staticmethod
+    def _fetch_plan(cur):
+        return '\n'.join(row[0] for row in cur.fetchall())
+
+    def _explain(self, cur, statement, parameters=None):
+        # guarded by savepoint to keep the transaction usable on failure
+        in_transaction = not cur.connection.autocommit
+        try:
+            if in_transaction:
+                cur.execute('SAVEPOINT explain_statement;')
+            cur.execute('EXPLAIN ' + statement, parameters)
+            return self._fetch_plan(cur)
+        except Exception as e:
+            if in_transaction:
+                cur.execute('ROLLBACK TO SAVEPOINT explain_statement;')
+            logging.info('Unable to explain statement: {}'.format(e))
+
+    @staticmethod
+    def _plan_rows(plan):
+        """Rows returned by the top node of EXPLAIN ANALYZE output. For
+        data modifying statements (their node returns no rows), rows fed
+        into the modify node by its child node."""
+        lines = plan.split('\n')
+        top = lines[0]
+        if MODIFY_NODE_RE.match(top):
+            top = next((line for line in lines[1:]
+                        if CHILD_NODE_RE.match(line)), '')
+        match = ACTUAL_ROWS_RE.search(top)
+        return int(match.group(1)) if match else None
+
+    def _execute(self, cur, statement, parameters=None, prefix=None,
+                 explain=True):
+        prefix = prefix + ' ' if prefix else ''
+        if not self.instrument:
+            cur.execute(prefix + statement, parameters)
+            return
+
+        # only single statements can be explained
+        explainable = explain and EXPLAINABLE_RE.match(statement) is not None
+        plan = None
+        started_at = time.time()
+        if self.explain == 'analyze' and explainable:
+            cur.execute(prefix + 'EXPLAIN (ANALYZE, BUFFERS) ' + statement,
+                        parameters)
+            duration = time.time() - started_at
+            plan = self._fetch_plan(cur)
+            rowcount = self._plan_rows(plan)
+        else:
+            cur.execute(prefix + statement, parameters)
+            duration = time.time() - started_at
+            rowcount = cur.rowcount
+
+        slow = (self.slow_threshold is not None and
+                duration >= self.slow_threshold)
+        if slow and plan is None and self.explain == 'plan' and explainable:
+            plan = self._explain(cur, statement, parameters)
+
+        stats = {
+            'sql': statement,
+            'duration': duration,
+            'rowcount': rowcount,
+            'plan': plan,
+        }
+        self.statement_stats.append(stats)
+        Stats.timing('postgres_hook.statement', duration * 1000)
+        if slow:
+            Stats.incr('postgres_hook.slow_statements')
+            logging.warning('Slow statement ({:.1f} s, {} rows): {}{}'.format(
+                duration, rowcount, statement,
+                '\n' + plan if plan else ''))
+        else:
+            logging.info('Statement took {:.1f} s, {} rows'.format(
+                duration, rowcount))
+
+    @staticmethod
+    def _is_terminated(statement):
+        """Whether the statement ends with a semicolon which is not
+        a part of a trailing -- comment."""
+        statement = statement.rstrip()
+        last_line = statement.rsplit('\n', 1)[-1]
+        return statement.endswith(';') and '--' not in last_line
+
+    def _run_batch(self, conn, cur, sql, parameters=None):
+        if self.fail_silently:
+            # one round trip per statement, failed ones are rolled back
+            # to the savepoint set in front of them
+            savepoint = 'SAVEPOINT batch_statement;'
+            for i, s in enumerate(sql):
+                logging.info(s)
+                if i > 0:
+                    savepoint = 'RELEASE SAVEPOINT batch_statement; ' \
+                        'SAVEPOINT batch_statement;'
+                try:
+                    self._execute(cur, s, parameters, prefix=savepoint)
+                except Exception as e:
+                    cur.execute('ROLLBACK TO SAVEPOINT batch_statement;')
+                    logging.exception(e)
+        elif parameters is not None:
+            # parameters apply to each statement, not to the joined script
+            for s in sql:
+                logging.info(s)
+                self._execute(cur, s, parameters)
+        else:
+            # on its own line, the semicolon can't end up in a -- comment
+            batch = '\n'.join(
+                s if self._is_terminated(s) else s + '\n;' for s in sql)
+            logging.info(batch)
+            self._execute(cur, batch, explain=len(sql) == 1)
+        conn.commit()
+
     def run(self, sql, autocommit=False, parameters=None):
         """
         Runs a command or a list of commands. Pass a list of sql
         statements to the sql parameter to get them to execute
         sequentially
 
+        In ``batch`` mode the statements are sent as a single
+        multi-statement execution in one transaction which is committed
+        once (one execution per statement when ``parameters`` are given).
+        With ``fail_silently`` set, each statement is guarded by a
+        savepoint, so failed statements are skipped one at a time.
+        ``autocommit`` is ignored in this mode.
+
         :param sql: the sql statement to be executed (str) or a list of
             sql statements to execute
-        :type sql: str or list
+        :type sql: str or psycopg2.sql.Composable or list
         :param autocommit: What to set the connection's autocommit setting to
             before executing the query.
         :type autocommit: bool
@@ -57,8 +967,22 @@ class PostgresHook(PostgresHookBase):
         :type parameters: mapping or iterable
         """
         conn = self.get_conn()
-        if isinstance(sql, str):
+        if isinstance(sql, (str, pgsql.Composable)):
             sql = [sql]
+        sql = [self._as_string(s, conn) for s in sql]
+
+        if self.batch:
+            self.set_autocommit(conn, False)
+            cur = conn.cursor()
+            try:
+                self._run_batch(conn, cur, sql, parameters)
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cur.close()
+                self.release_conn(conn)
+            return
 
         self.set_autocommit(conn, autocommit)
 
@@ -66,21 +990,21 @@ class PostgresHook(PostgresHookBase):
         for s in sql:
             logging.info(s)
             if parameters is not None:
-                cur.execute(s, parameters)
+                self._execute(cur, s, parameters)
             else:
                 if self.fail_silently:
                     try:
-                        cur.execute(s)
+                        self._execute(cur, s)
                         conn.commit()
                     except Exception as e:
                         conn.rollback()
                         logging.exception(e)
                 else:
-                    cur.execute(s)
+                    self._execute(cur, s)
                     conn.commit()
 
         cur.close()
-        conn.close()
+        self.release_conn(conn)
 
 
 class PostgresOperator(PostgresOperatorBase):
@@ -88,70 +1012,165 @@ class PostgresOperator(PostgresOperatorBase):
     """PostgreSQL operator which uses PostgresHook"""
 
     @apply_defaults
-    def __init__(self, database=None, fail_silently=True, *args, **kwargs):
+    def __init__(self, database=None, fail_silently=True, pooled=None,
+                 batch=False, instrument=False, explain=None,
+                 slow_threshold=None, *args, **kwargs):
         super(PostgresOperator, self).__init__(*args, **kwargs)
         self.fail_silently = fail_silently
         self.schema = database
+        self.pooled = pooled
+        self.batch = batch
+        self.instrument = instrument
+        self.explain = explain
+        self.slow_threshold = slow_threshold
 
     def pre_execute(self, context):
         self.hook = PostgresHook(postgres_conn_id=self.postgres_conn_id,
                                  database=self.schema,
-                                 fail_silently=self.fail_silently)
+                                 fail_silently=self.fail_silently,
+                                 pooled=self.pooled,
+                                 batch=self.batch,
+                                 instrument=self.instrument,
+                                 explain=self.explain,
+                                 slow_threshold=self.slow_threshold)
 
     def execute(self, context):
         logging.info('Executing: ' + str(self.sql))
         self.hook.run(self.sql, self.autocommit, parameters=self.parameters)
+        if self.instrument:
+            context['ti'].xcom_push(key='statement_stats',
+                                    value=self.hook.statement_stats)
 
 
 class CreateDatabase(PostgresOperatorStatic):
 
-    """Operator which creates database in PostgreSQL."""
+    """Operator which creates database in PostgreSQL.
 
-    _sql = [
-        "CREATE DATABASE {{ params.database_name }};",  # keep create db at top
-        "GRANT ALL PRIVILEGES ON DATABASE {{ params.database_name }} "
-        "TO {{ params.user }};",  # set user in pre_execute if not in params
+    Only missing objects are provisioned: the state of the database,
+    the user and its settings and privileges is read from pg_database and
+    pg_roles in one query and only the missing statements are applied
+    over a single pooled connection.
+
+    With ``template`` param set, the database is cloned from the template
+    database by CREATE DATABASE ... TEMPLATE. Idle connections to the
+    template are terminated first, as the template must not be accessed.
+    """
+
+    _role_settings = [
+        ('client_encoding', 'utf8'),
+        ('default_transaction_isolation', 'read committed'),
+        ('timezone', 'UTC'),
     ]
 
+    _privileges = ['CREATE', 'CONNECT', 'TEMPORARY']
+
+    _state_sql = """
+        SELECT
+            EXISTS (SELECT 1 FROM pg_database WHERE datname = %(database)s),
+            EXISTS (SELECT 1 FROM pg_roles WHERE rolname = %(user)s),
+            (SELECT rolconfig FROM pg_roles WHERE rolname = %(user)s),
+            ARRAY(
+                SELECT privilege FROM unnest(%(privileges)s) privilege
+                WHERE CASE
+                    WHEN EXISTS (SELECT 1 FROM pg_database
+                                 WHERE datname = %(database)s)
+                     AND EXISTS (SELECT 1 FROM pg_roles
+                                 WHERE rolname = %(user)s)
+                    THEN has_database_privilege(
+                        %(user)s, %(database)s, privilege)
+                    ELSE false
+                END
+            );
+    """
+
+    _terminate_sql = (
+        "SELECT pg_terminate_backend(pid) FROM pg_stat_activity "
+        "WHERE datname = {} AND pid <> pg_backend_pid() "
+        "AND state LIKE 'idle%';"  # idle and idle in transaction
+    )
+
     def pre_execute(self, context):
         params = context['params']
+        self.database_name = params['database_name']
         company = params.get('company')
         if company is not None:
-            db_name = params['database_name']
-            self.params['database_name'] = company.lower() + '_' + db_name
-
-        hook = PostgresHook(postgres_conn_id=self.postgres_conn_id)
-        conn = hook.get_connection(self.postgres_conn_id)
-        if conn is not None:
-            user = params.get('user', conn.login)
-            if user == conn.login:
-                self.params['user'] = user
+            self.database_name = company.lower() + '_' + self.database_name
+
+        conn = PostgresHook(postgres_conn_id=self.postgres_conn_id)\
+            .get_connection(self.postgres_conn_id)
+        self.owner = conn.login if conn is not None else None
+        self.user = params.get('user', self.owner)
+        self.password = params.get('password')
+        self.template = params.get('template')
+
+    def _plan(self, state):
+        """Statements creating what is missing in the ``state``."""
+        db_exists, user_exists, role_config, privileges = state
+        database = pgsql.SQL(self.database_name)
+        user = pgsql.SQL(self.user)
+        plan = []
+
+        if self.user != self.owner:
+            if not user_exists:
+                plan.append(pgsql.SQL(
+                    "CREATE USER {} WITH PASSWORD {};"
+                ).format(user, pgsql.Literal(self.password)))
+            config = dict(
+                item.split('=', 1) for item in (role_config or []))
+            config = {k.lower(): v.lower() for k, v in config.items()}
+            for name, value in self._role_settings:
+                if config.get(name) != value.lower():
+                    plan.append(pgsql.SQL(
+                        "ALTER ROLE {} SET {} TO {};"
+                    ).format(user, pgsql.SQL(name), pgsql.Literal(value)))
+
+        if not db_exists:
+            if self.template:
+                plan.append(pgsql.SQL(self._terminate_sql).format(
+                    pgsql.Literal(self.template.lower())))
+                plan.append(pgsql.SQL(
+                    "CREATE DATABASE {} TEMPLATE {};"
+                ).format(database, pgsql.SQL(self.template)))
             else:
-                for item in reversed([
-                    "CREATE USER {{ params.user }} "
-                    "WITH PASSWORD '{{ params.password }}';",
-                    "ALTER ROLE {{ params.user }} "
-                    "SET client_encoding TO 'utf8';",
-                    "ALTER ROLE {{ params.user }} "
-                    "SET default_transaction_isolation TO 'read committed';",
-                    "ALTER ROLE {{ params.user }} SET timezone TO 'UTC';",
-                ]):
-                    self._sql.insert(1, item)
-
-        self.sql = self._sql
-        context['ti'].render_templates()
+                plan.append(pgsql.SQL(
+                    "CREATE DATABASE {};").format(database))
 
-    def execute(self, context):
-        sqls = (self.sql[0:1], self.sql[1:])
-        logging.info('Executing: ' + str(self.sql))
+        missing = set(self._privileges) - set(privileges or [])
+        if missing and (db_exists or self.user != self.owner):
+            plan.append(pgsql.SQL(
+                "GRANT ALL PRIVILEGES ON DATABASE {} TO {};"
+            ).format(database, user))
 
-        self.hook = PostgresHook(postgres_conn_id=self.postgres_conn_id,
-                                 fail_silently=True)  # fails if db exists
-        self.hook.run(sqls[0], self.autocommit, parameters=self.parameters)
-        self.hook = PostgresHook(postgres_conn_id=self.postgres_conn_id,
-                                 fail_silently=False)  # should not fail
-        if len(sqls[1]) > 0:
-            self.hook.run(sqls[1], self.autocommit, parameters=self.parameters)
+        return plan
+
+    def execute(self, context):
+        hook = PostgresHook(postgres_conn_id=self.postgres_conn_id,
+                            pooled=True)
+        conn = hook.get_conn()
+        conn.autocommit = True  # CREATE DATABASE can't run in transaction
+        cur = conn.cursor()
+        try:
+            # unquoted names are folded to lower case
+            cur.execute(self._state_sql, {
+                'database': self.database_name.lower(),
+                'user': self.user.lower(),
+                'privileges': self._privileges,
+            })
+            plan = [statement.as_string(conn)
+                    for statement in self._plan(cur.fetchone())]
+            if not plan:
+                logging.info('Database {} is up to date.'.format(
+                    self.database_name))
+            for statement in plan:
+                if statement.startswith('CREATE USER'):
+                    logging.info('CREATE USER {}'.format(self.user))
+                else:
+                    logging.info(statement)
+                cur.execute(statement)
+        finally:
+            cur.close()
+            hook.release_conn(conn)
+        self.sql = plan
 
 
 class DropDatabase(PostgresOperatorStatic):
@@ -189,19 +1208,215 @@ class ChangeDatabaseName(PostgresOperatorStatic):
                       parameters=self.parameters)
 
 
+class CopyTable(BaseOperator):
+
+    """Copy tables between two databases without a file in between.
+
+    Rows are streamed as ``COPY ... TO STDOUT (FORMAT binary)`` from the
+    source into ``COPY ... FROM STDIN (FORMAT binary)`` on the target
+    through a pipe, so only a buffer of data is held in memory. Binary
+    format requires the target table to have the same column types
+    in the same order as the source.
+
+    :param tables: table names or ``(source, target)`` pairs
+    :param truncate: truncate the target table in the same transaction
+    :param parallel: number of tables copied at once
+    """
+
+    template_fields = ('source_database', 'target_database', 'tables')
+
+    @apply_defaults
+    def __init__(self, tables, source_conn_id='postgres_default',
+                 target_conn_id='postgres_default', source_database=None,
+                 target_database=None, truncate=False, parallel=1,
+                 *args, **kwargs):
+        super(CopyTable, self).__init__(*args, **kwargs)
+        self.tables = tables
+        self.source_conn_id = source_conn_id
+        self.target_conn_id = target_conn_id
+        self.source_database = source_database
+        self.target_database = target_database
+        self.truncate = truncate
+        self.parallel = parallel
+
+    @staticmethod
+    def _table(name):
+        return pgsql.SQL('.').join(
+            pgsql.Identifier(part) for part in name.split('.'))
+
+    def _produce(self, hook, table, writer, errors):
+        try:
+            hook.copy(pgsql.SQL('COPY {} TO STDOUT (FORMAT binary)').format(
+                self._table(table)), writer)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            try:
+                writer.close()
+            except (IOError, OSError):
+                pass  # consumer is gone already
+
+    def _copy_table(self, source, target):
+        start = time.time()
+        source_hook = PostgresHook(postgres_conn_id=self.source_conn_id,
+                                   database=self.source_database)
+        target_hook = PostgresHook(postgres_conn_id=self.target_conn_id,
+                                   database=self.target_database)
+
+        read_fd, write_fd = os.pipe()
+        reader = io.open(read_fd, 'rb')
+        writer = io.open(write_fd, 'wb')
+        errors = []
+        producer = threading.Thread(
+            target=self._produce, args=(source_hook, source, writer, errors))
+
+        conn = cur = None
+        try:
+            conn = target_hook.get_conn()
+            cur = conn.cursor()
+            producer.start()
+            if self.truncate:
+                cur.execute(pgsql.SQL('TRUNCATE {}').format(
+                    self._table(target)))
+            cur.copy_expert(
+                pgsql.SQL('COPY {} FROM STDIN (FORMAT binary)').format(
+                    self._table(target)).as_string(conn),
+                reader, COPY_BUFFER_SIZE)
+            producer.join()
+            if errors:
+                raise errors[0]
+            conn.commit()
+            rows = cur.rowcount
+        except Exception:
+            if conn is not None:
+                conn.rollback()
+            raise
+        finally:
+            reader.close()  # unblocks the producer on failure
+            if producer.ident is not None:
+                producer.join()
+            else:
+                writer.close()  # producer has not taken it over
+            if cur is not None:
+                cur.close()
+            if conn is not None:
+                target_hook.release_conn(conn)
+
+        logging.info('Copied {} rows from {} to {} in {:.2f} s'.format(
+            rows, source, target, time.time() - start))
+        return rows
+
+    def execute(self, context):
+        pairs = [(t, t) if isinstance(t, six.string_types) else tuple(t)
+                 for t in self.tables]
+        if not pairs:
+            raise AirflowException('No tables to copy.')
+
+        workers = max(1, min(self.parallel, len(pairs)))
+        rows = utils.run_parallel(self._copy_table, pairs, workers)
+        return dict(zip([target for _, target in pairs], rows))
+
+
 class CreateTableWithColumns(PostgresOperator):
 
-    """Create database with columns."""
+    """Create database with columns.
+
+    With ``fast_load`` set, the ``csv_file`` (local, not gzipped) is
+    loaded into the table in the same transaction: the table is created
+    UNLOGGED, filled by COPY ... FREEZE, indexes and constraints (primary
+    key, unique, exclusion, check, foreign key) of the replaced table are
+    rebuilt after the load and the table is analyzed. With ``set_logged``
+    set, the table is switched to LOGGED at the end.
+
+    With ``infer_types`` set, column types (boolean, integer, bigint,
+    numeric, date, timestamp) are inferred from the first ``sample_size``
+    bytes of the ``csv_file`` instead of declaring all columns as TEXT.
+
+    The ``csv_file`` can be a local path or ``ftp://<conn_id>/path`` or
+    ``s3://bucket/key``, optionally gzipped (``.gz``). Only the first
+    block of the file is read to get the header.
+    """
 
     _sql = [
         "DROP TABLE IF EXISTS {{ params.table_name }};",
         "CREATE TABLE {{ params.table_name }} ({{ params.table_columns }});"
     ]
 
+    # candidate types from the narrowest, first matching one is used
+    _column_types = [
+        ('BOOLEAN', lambda v: v.lower() in (
+            'true', 'false', 't', 'f', 'yes', 'no')),
+        ('INTEGER', lambda v: CreateTableWithColumns._is_int(v, 31)),
+        ('BIGINT', lambda v: CreateTableWithColumns._is_int(v, 63)),
+        ('NUMERIC', lambda v: (
+            NUMERIC_RE.match(v) is not None and not LEADING_ZERO_RE.match(v))),
+        ('DATE', lambda v: CreateTableWithColumns._is_datetime(
+            v, DATE_RE)),
+        ('TIMESTAMP', lambda v: CreateTableWithColumns._is_datetime(
+            v, TIMESTAMP_RE)),
+    ]
+
     @apply_defaults
-    def __init__(self, *args, **kwargs):
+    def __init__(self, fast_load=False, set_logged=False, infer_types=False,
+                 sample_size=10 * 1024 * 1024, *args, **kwargs):
         super(CreateTableWithColumns, self).__init__(sql=self._sql,
                                                      *args, **kwargs)
+        self.fast_load = fast_load
+        self.set_logged = set_logged
+        self.infer_types = infer_types
+        self.sample_size = sample_size
+
+    @staticmethod
+    def _is_int(value, bits):
+        if not INTEGER_RE.match(value) or LEADING_ZERO_RE.match(value):
+            return False
+        return -2 ** bits <= int(value) < 2 ** bits
+
+    @staticmethod
+    def _is_datetime(value, regex):
+        if not regex.match(value):
+            return False
+        try:
+            # parse the whole value, time part included
+            BinaryCopyEncoder._to_microseconds(value)
+        except ValueError:
+            return False
+        return True
+
+    @classmethod
+    def _infer_column_types(cls, csv_file_path, dialect=None,
+                            sample_size=10 * 1024 * 1024,
+                            encoding='utf-8-sig'):
+        """Infer column types from the first ``sample_size`` bytes.
+
+        ``dialect`` are csv.reader arguments as returned by
+        :meth:`_read_table_header`.
+        """
+        sample, eof = cls._read_head(csv_file_path, sample_size)
+        sample = sample.decode(encoding, errors='replace')
+
+        rows = list(csv.reader(io.StringIO(sample), **(dialect or {})))
+        if not rows:
+            raise AirflowException('File {} is empty'.format(csv_file_path))
+        if not eof and len(rows) > 2:
+            rows = rows[:-1]  # possibly incomplete record
+        header, rows = rows[0], rows[1:]
+
+        types = []
+        for i in range(len(header)):
+            candidates = list(cls._column_types)
+            seen = False
+            for row in rows:
+                if not candidates:
+                    break
+                value = row[i].strip() if i < len(row) else ''
+                if not value:
+                    continue
+                seen = True
+                candidates = [(name, check) for name, check in candidates
+                              if check(value)]
+            types.append(candidates[0][0] if seen and candidates else 'TEXT')
+        return types
 
     @classmethod
     def _parse_extra_args(cls, args):
@@ -235,34 +1450,368 @@ class CreateTableWithColumns(PostgresOperator):
         return parsed
 
     @classmethod
-    def _get_table_columns(cls, csv_file_path, extra=None):
-        from io import StringIO
-        from csvkit.utilities.csvcut import CSVCut
-        output = StringIO()
-        extra_args = cls._parse_extra_args(extra) if extra else []
-        args = ['-n', *extra_args, csv_file_path]
-        print(args)
-        csvcut = CSVCut(args=args)
-        csvcut.output_file = output
-        csvcut.run()
-        csv_columns = [
-            col.split(': ')[1]
-            for col in output.getvalue().splitlines()
-        ]
+    def _get_dialect(cls, extra=None):
+        """csv.reader arguments and encoding from csvkit options."""
+        args = cls._parse_extra_args(extra) if extra else []
+        dialect, encoding = {}, 'utf-8-sig'
+        options = iter(args)
+        for arg in options:
+            if arg in ['-d', '--delimiter']:
+                dialect['delimiter'] = next(options)
+            elif arg in ['-t', '--tabs']:
+                dialect['delimiter'] = '\t'
+            elif arg in ['-q', '--quotechar']:
+                dialect['quotechar'] = next(options)
+            elif arg in ['-e', '--encoding']:
+                encoding = next(options)
+        return dialect, encoding
+
+    @staticmethod
+    def _pg_encoding(encoding):
+        """PostgreSQL name of the Python encoding."""
+        name = codecs.lookup(encoding).name
+        if name in ('utf-8', 'utf-8-sig'):
+            return 'UTF8'
+        pg_names = sorted(
+            (pg_name for pg_name, codec
+             in psycopg2.extensions.encodings.items()
+             if codecs.lookup(codec).name == name), key=len)
+        return pg_names[0] if pg_names else encoding
+
+    @staticmethod
+    def _read_block(csv_file_path, size):
+        """Read first ``size`` bytes of local, FTP or S3 file."""
+        engine, target, path = FileOperator._split_path(csv_file_path)
+
+        if engine == 'ftp':
+            import ftplib
+            from airflow_plugins.hooks import FTPHook
+            hook = FTPHook(target)
+            ftp = hook.get_conn()
+            ftp.voidcmd('TYPE I')  # as retrbinary, ASCII mode mangles data
+            sock = ftp.transfercmd('RETR ' + path)
+            chunks, received = [], 0
+            while received < size:
+                chunk = sock.recv(min(size - received, 64 * 1024))
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                received += len(chunk)
+            sock.close()
+            try:
+                ftp.voidresp()  # transfer aborted on our side
+            except ftplib.all_errors:
+                pass
+            hook.close_conn()
+            return b''.join(chunks)
+
+        if engine == 's3':
+            from airflow.hooks.S3_hook import S3Hook
+            hook = S3Hook('s3.stories.bi')
+            key = hook.get_bucket(target or 'storiesbi-datapipeline')\
+                .get_key(path.lstrip('/'))
+            if key is None:
+                raise AirflowException(
+                    'File {} does not exist'.format(csv_file_path))
+            if key.size == 0:
+                return b''
+            return key.get_contents_as_string(
+                headers={'Range': 'bytes=0-{}'.format(size - 1)})
+
+        with open(path, mode='rb') as f:
+            return f.read(size)
+
+    @classmethod
+    def _read_head(cls, csv_file_path, size):
+        """Return first ``size`` bytes of the (possibly gzipped) file and
+        whether the whole file has been read."""
+        data = cls._read_block(csv_file_path, size)
+        eof = len(data) < size
+        if csv_file_path.endswith('.gz'):
+            # partial gzip stream can be decompressed as well, the output
+            # is bounded as well as the compressed input
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            data = decompressor.decompress(data, size)
+            eof = eof and not decompressor.unconsumed_tail
+        return data, eof
+
+    @staticmethod
+    def _has_record(text, quotechar='"'):
+        """Whether the text contains a line break outside of quotes."""
+        start = 0
+        quoted = False
+        while True:
+            end = text.find('\n', start)
+            if end == -1:
+                return False
+            quoted ^= text.count(quotechar, start, end) % 2 == 1
+            if not quoted:
+                return True
+            start = end + 1
+
+    @classmethod
+    def _read_table_header(cls, csv_file_path, extra=None, delimiter=None,
+                           block_size=64 * 1024, max_size=16 * 1024 * 1024):
+        """Return table columns, csv.reader arguments and encoding.
+
+        The delimiter of ``extra`` takes precedence over ``delimiter``,
+        when none is given it is sniffed from the header.
+        """
+        dialect, encoding = cls._get_dialect(extra)
+        if delimiter and 'delimiter' not in dialect:
+            dialect['delimiter'] = delimiter
+        size = block_size
+        while True:
+            data, eof = cls._read_head(csv_file_path, size)
+            text = data.decode(encoding, errors='replace')
+            if (eof or size >= max_size or
+                    cls._has_record(text, dialect.get('quotechar', '"'))):
+                break
+            size *= 4
+
+        if 'delimiter' not in dialect:
+            try:
+                sniffed = csv.Sniffer().sniff(text, delimiters=',;\t|')
+            except csv.Error:
+                pass
+            else:
+                dialect['delimiter'] = sniffed.delimiter
+        dialect.setdefault('delimiter', ',')
+        csv_columns = next(csv.reader(io.StringIO(text), **dialect), None)
+        if not csv_columns:
+            raise AirflowException('File {} is empty'.format(csv_file_path))
+
         table_columns = [
             '"{}"'.format(col)
             if (col != col.lower() or ' ' in col) else col
             for col in csv_columns
         ]
-        return table_columns
+        return table_columns, dialect, encoding
+
+    @classmethod
+    def _get_table_columns(cls, csv_file_path, extra=None, **kwargs):
+        return cls._read_table_header(csv_file_path, extra, **kwargs)[0]
+
+    def _read_columns(self, csv_file_path, extra=None, delimiter=None):
+        """Return list of (column, type) pairs of the CSV file."""
+        columns, dialect, encoding = self._read_table_header(
+            csv_file_path, extra, delimiter)
+        if not self.infer_types:
+            return [(col, 'TEXT') for col in columns]
+        types = self._infer_column_types(
+            csv_file_path, dialect, self.sample_size, encoding)
+        if len(types) != len(columns):
+            raise AirflowException(
+                'Header of {} has {} columns, but {} types were '
+                'inferred'.format(csv_file_path, len(columns), len(types)))
+        return list(zip(columns, types))
 
     def pre_execute(self, context):
         if context['params'].get('table_columns') is None:
-            columns = self._get_table_columns(context['params']['csv_file'],
-                                              context['params'].get('extra'))
+            table_columns = self._read_columns(
+                context['params']['csv_file'],
+                context['params'].get('extra'),
+                context['params'].get('delimiter'))
             self.params['table_columns'] = ', '.join([
-                '{} TEXT'.format(col) for col in columns
+                '{} {}'.format(col, col_type)
+                for col, col_type in table_columns
             ])
             self.sql = self._sql
             context['ti'].render_templates()
         super(CreateTableWithColumns, self).pre_execute(context)
+
+    _indexes_sql = (
+        "SELECT pg_get_indexdef(i.indexrelid) FROM pg_index i "
+        "WHERE i.indrelid = to_regclass(%s) AND NOT EXISTS ("
+        "SELECT 1 FROM pg_constraint c WHERE c.conindid = i.indexrelid);")
+
+    _constraints_sql = (
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE conrelid = to_regclass(%s) "
+        "AND contype IN ('p', 'u', 'x', 'c', 'f') ORDER BY contype DESC;")
+
+    def _fast_load(self, context):
+        params = context['params']
+        if (FileOperator._split_path(params['csv_file'])[0]
+                or params['csv_file'].endswith('.gz')):
+            raise AirflowException(
+                'Fast load needs local uncompressed csv_file, got {}'.format(
+                    params['csv_file']))
+        table = pgsql.SQL(params['table_name'])
+        drop_sql, create_sql = self.sql
+        create_sql = create_sql.replace(
+            'CREATE TABLE', 'CREATE UNLOGGED TABLE', 1)
+        columns, dialect, encoding = self._read_table_header(
+            params['csv_file'], params.get('extra'), params.get('delimiter'))
+        fields = pgsql.SQL(', '.join(columns))
+        copy_sql = pgsql.SQL(
+            "COPY {} ({}) FROM STDIN WITH "
+            "(FORMAT csv, HEADER true, DELIMITER {}, QUOTE {}, ENCODING {}, "
+            "FREEZE true, FORCE_NULL ({}))"
+        ).format(table, fields, pgsql.Literal(dialect['delimiter']),
+                 pgsql.Literal(dialect.get('quotechar', '"')),
+                 pgsql.Literal(self._pg_encoding(encoding)), fields)
+
+        conn = self.hook.get_conn()
+        conn.autocommit = False
+        cur = conn.cursor()
+        started_at = time.time()
+        try:
+            # keep indexes and constraints of the replaced table to rebuild
+            # them after load, constraint indexes are created by constraints
+            cur.execute(self._indexes_sql, (params['table_name'],))
+            indexes = [row[0] for row in cur.fetchall()]
+            cur.execute(self._constraints_sql, (params['table_name'],))
+            constraints = [
+                pgsql.SQL('ALTER TABLE {} ADD CONSTRAINT {} {}').format(
+                    table, pgsql.Identifier(name), pgsql.SQL(definition))
+                for name, definition in cur.fetchall()]
+            for statement in [drop_sql, create_sql]:
+                logging.info(statement)
+                cur.execute(statement)
+            with open(params['csv_file'], mode='rb') as f:
+                cur.copy_expert(copy_sql.as_string(conn), f, COPY_BUFFER_SIZE)
+            logging.info('Loaded {} rows in {:.1f} s'.format(
+                cur.rowcount, time.time() - started_at))
+            for statement in indexes:
+                logging.info(statement)
+                cur.execute(statement)
+            for statement in constraints:
+                statement = statement.as_string(conn)
+                logging.info(statement)
+                cur.execute(statement)
+            cur.execute(pgsql.SQL("ANALYZE {}").format(table))
+            if self.set_logged:
+                cur.execute(pgsql.SQL("ALTER TABLE {} SET LOGGED").format(
+                    table))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+            self.hook.release_conn(conn)
+
+        logging.info('Fast load finished in {:.1f} s'.format(
+            time.time() - started_at))
+
+    def execute(self, context):
+        if self.fast_load:
+            return self._fast_load(context)
+        return super(CreateTableWithColumns, self).execute(context)
+
+
+class CreatePartitionedTableWithColumns(CreateTableWithColumns):
+
+    """Create declaratively partitioned table with columns.
+
+    Same as :class:`CreateTableWithColumns`, the table is partitioned by
+    ``partition_column`` into ``partitions`` hash partitions or into
+    ``range`` partitions between ``partition_bounds``, see
+    :class:`PartitionScheme`. The partitions can be loaded concurrently
+    by :class:`SplitCSVtoDB` with the same partitioning arguments.
+    """
+
+    _sql = [
+        "DROP TABLE IF EXISTS {{ params.table_name }};",
+        "CREATE TABLE {{ params.table_name }} ({{ params.table_columns }}) "
+        "PARTITION BY {{ params.partition_key }};"
+    ]
+
+    @apply_defaults
+    def __init__(self, partition_column, partition_by='hash', partitions=4,
+                 partition_bounds=None, *args, **kwargs):
+        super(CreatePartitionedTableWithColumns, self).__init__(
+            *args, **kwargs)
+        if self.fast_load:
+            raise AirflowException(
+                'Fast load is not supported for partitioned tables')
+        self.partition_scheme = PartitionScheme(
+            partition_column, partition_by, partitions, partition_bounds)
+        self.params['partition_key'] = self.partition_scheme.key_sql
+
+    def pre_execute(self, context):
+        super(CreatePartitionedTableWithColumns, self).pre_execute(context)
+        self.sql = list(self.sql) + self.partition_scheme.get_create_sql(
+            context['params']['table_name'])
+
+
+class CreateTablesWithColumns(CreateTableWithColumns):
+
+    """Create tables for all CSV files in directory.
+
+    ``csv_files`` param is a directory (``*.csv`` and ``*.csv.gz`` files)
+    or a glob. Headers of the files are read concurrently by ``parallel``
+    threads and all tables (named after the files, with optional
+    ``table_prefix`` param, may include a schema) are created in one
+    transaction over one connection. File names which do not make a valid
+    unquoted identifier (e.g. ``2018-orders.csv`` without prefix) are
+    rejected. The table to columns map is pushed to XCom as
+    ``table_columns``. Fast load is not supported.
+    """
+
+    @apply_defaults
+    def __init__(self, parallel=8, fail_silently=False, *args, **kwargs):
+        super(CreateTablesWithColumns, self).__init__(
+            fail_silently=fail_silently, *args, **kwargs)
+        if self.fast_load:
+            raise AirflowException(
+                'Fast load is not supported for multiple tables')
+        self.parallel = parallel
+        self.batch = True
+
+    @staticmethod
+    def _get_files(path):
+        if os.path.isdir(path):
+            return sorted(glob.glob(os.path.join(path, '*.csv')) +
+                          glob.glob(os.path.join(path, '*.csv.gz')))
+        return sorted(glob.glob(path))
+
+    @staticmethod
+    def _get_table_name(path, prefix=''):
+        name = os.path.basename(path)
+        for ext in ['.gz', '.csv']:
+            if name.lower().endswith(ext):
+                name = name[:-len(ext)]
+        return prefix + re.sub(r'\W+', '_', name).lower()
+
+    def pre_execute(self, context):
+        params = context['params']
+        files = self._get_files(params['csv_files'])
+        if not files:
+            raise AirflowException(
+                'No CSV files found in {}'.format(params['csv_files']))
+        tables = [self._get_table_name(path, params.get('table_prefix', ''))
+                  for path in files]
+        for path, table in zip(files, tables):
+            if not TABLE_NAME_RE.match(table):
+                raise AirflowException(
+                    'File {} maps to invalid table name {}'.format(
+                        path, table))
+        for i, table in enumerate(tables):
+            if table in tables[:i]:
+                raise AirflowException(
+                    'Files {} and {} map to the same table {}'.format(
+                        files[tables.index(table)], files[i], table))
+        logging.info('Reading headers of {} files'.format(len(files)))
+        with ThreadPoolExecutor(max_workers=self.parallel) as executor:
+            columns = list(executor.map(
+                lambda path: self._read_columns(
+                    path, params.get('extra'), params.get('delimiter')),
+                files))
+
+        self.table_columns = {}
+        self.sql = []
+        for table, table_columns in zip(tables, columns):
+            self.table_columns[table] = [col for col, _ in table_columns]
+            self.sql.extend([
+                "DROP TABLE IF EXISTS {};".format(table),
+                "CREATE TABLE {} ({});".format(table, ', '.join(
+                    '{} {}'.format(col, col_type)
+                    for col, col_type in table_columns)),
+            ])
+        PostgresOperator.pre_execute(self, context)
+
+    def execute(self, context):
+        PostgresOperator.execute(self, context)
+        context['ti'].xcom_push(key='table_columns', value=self.table_columns)
@@ -1,6 +1,8 @@
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
 from copy import deepcopy
 from datetime import datetime
 
+from airflow.exceptions import AirflowException
 from airflow.models import Variable
 from pytz import timezone
 
@@ -126,3 +128,23 @@ def get_utc_offset(tz='Europe/Prague'):  # as hours
     dt = utcnow.astimezone(tz).replace(tzinfo=None)
     offset = (dt - now).total_seconds() / (60 * 60)
     return offset  # float
+
+
+def run_parallel(func, args_list, workers):
+    """Call func for each args in a thread pool and return the results.
+    The first failure cancels tasks which have not started yet.
+    """
+    executor = ThreadPoolExecutor(max_workers=workers)
+    futures = [executor.submit(func, *args) for args in args_list]
+    done, not_done = wait(futures, return_when=FIRST_EXCEPTION)
+    for future in not_done:
+        future.cancel()
+    executor.shutdown(wait=True)
+
+    failed = [f for f in futures if f.done() and not f.cancelled()
+              and f.exception() is not None]
+    if failed:
+        raise AirflowException('{} of {} task(s) failed: {}'.format(
+            len(failed), len(futures), failed[0].exception()))
+
+    return [f.result() for f in futures]
@@ -13,7 +13,7 @@ with open('HISTORY.rst') as history_file:
 
 requirements = [
     "python-slugify>=1.1.4",
-    "psycopg2>=2.6.2",
+    "psycopg2>=2.7",
     "boto==2.45.0",
     "csvkit==1.0.2",
     "slackclient==1.0.4",
@@ -27,7 +27,7 @@ setup_requirements = [
 
 test_requirements = [
     "pytest",
-    "psycopg2>=2.6.2",
+    "psycopg2>=2.7",
     "coverage==4.1",
     "pytest==3.0.7",
     "pytest-cov==2.4.0",
@@ -0,0 +1,680 @@
+import csv
+import gzip
+import io
+import struct
+import subprocess
+from datetime import date, datetime, timedelta, timezone
+
+import pytest
+from mock import Mock, patch
+from psycopg2 import sql
+from psycopg2.extensions import connection
+
+from airflow.exceptions import AirflowException
+from airflow_plugins import utils
+from airflow_plugins.operators.csv import (
+    CopyCSVtoDB,
+    CopyDBtoCSV,
+    CSVStats,
+    DBtoCSV,
+    FileRanges,
+    SplitCSVtoDB,
+    UpsertCSVtoDB
+)
+from airflow_plugins.operators.db import PostgresHook
+from tests.utils import render
+
+
+def test_split_ranges_keeps_quoted_records(tmpdir):
+    rows = [['id', 'text']] + [
+        [str(i), 'multi\nline "quoted"' if i % 3 else 'plain']
+        for i in range(100)
+    ]
+    output = io.StringIO()
+    csv.writer(output, lineterminator='\n').writerows(rows)
+    path = str(tmpdir.join('file.csv'))
+    with open(path, mode='w', newline='') as f:
+        f.write(output.getvalue())
+
+    header_end, ranges = SplitCSVtoDB._split_ranges(path, 4)
+    assert len(ranges) == 4
+
+    loaded = []
+    for byte_range in ranges:
+        with FileRanges(path, [(0, header_end), byte_range]) as f:
+            split = list(csv.reader(io.StringIO(f.read().decode())))
+        assert split[0] == rows[0]
+        loaded.extend(split[1:])
+    assert loaded == rows[1:]
+
+
+def test_db_to_csv_cache_reuses_output(tmpdir):
+    output = tmpdir.join('out.csv')
+    params = {'query': 'SELECT * FROM events e JOIN users u ON true',
+              'output_path_temp': str(output)}
+    operator = DBtoCSV(task_id='export', cache=True)
+    hook = Mock()
+    hook.get_records.return_value = [('events', 1, 0, 0, 10),
+                                     ('users', 5, 2, 0, 11)]
+    operator.get_hook = Mock(return_value=hook)
+    variables = {}
+
+    def export(context):
+        output.write('id\n1\n')
+
+    with patch('airflow_plugins.utils.get_variable', variables.get), \
+            patch('airflow_plugins.utils.create_variable',
+                  variables.__setitem__), \
+            patch('airflow_plugins.operators.BashOperator.execute',
+                  side_effect=export) as bash:
+        operator.execute({'params': params})
+        operator.execute({'params': params})
+        assert bash.call_count == 1
+        assert hook.get_records.call_args[1]['parameters'] == (
+            ['events', 'users'],)
+
+        hook.get_records.return_value = [('events', 2, 0, 0, 10),
+                                         ('users', 5, 2, 0, 11)]
+        operator.execute({'params': params})
+        assert bash.call_count == 2
+
+        # other database or sql2csv options
+        for name, value in [('db', 'postgresql://host'), ('extra', '-H')]:
+            params[name] = value
+            operator.execute({'params': params})
+            operator.execute({'params': params})
+        assert bash.call_count == 4
+
+        hook.get_records.return_value = [('events', None, None, None, None),
+                                         ('users', 5, 2, 0, 11)]
+        operator.execute({'params': params})
+        assert bash.call_count == 5
+
+
+def test_db_to_csv_incremental_advances_watermark():
+    params = {'query': 'SELECT * FROM events;', 'company': 'Kiwi'}
+    operator = DBtoCSV(task_id='export', incremental_column='created_at',
+                       initial_watermark=datetime(2018, 1, 1))
+    hook = Mock()
+    hook.get_first.side_effect = [
+        ('timestamp without time zone',), (datetime(2018, 1, 2, 3, 4, 5),)]
+    hook.get_conn.return_value = Mock(spec=connection, encoding='UTF8')
+    operator.get_hook = Mock(return_value=hook)
+    operator.render_template = Mock(return_value='sql2csv')
+    variables = {}
+
+    with patch('airflow_plugins.variables.ValueResolver.get_value',
+               side_effect=RuntimeError), \
+            patch('airflow_plugins.utils.create_variable',
+                  variables.__setitem__), \
+            patch('airflow_plugins.operators.BashOperator.execute') as bash:
+        bash.side_effect = lambda context: variables.copy()
+        operator.pre_execute({'params': params})
+        assert operator.bash_command == 'sql2csv'
+        assert 'created_at <= ' in params['query']
+        assert variables == {}  # not before the export
+        assert operator.execute({'params': params}) == {}
+
+    assert variables == {'kiwi_adhoc_airflow_export_date':
+                         '2018-01-02T03:04:05'}
+    assert 'date_trunc' in render(hook.get_first.call_args[0][0])
+
+
+def run_incremental(column_type, high, watermark):
+    """Run incremental DBtoCSV export, return stored variables and the
+    upper bound query."""
+    params = {'query': 'SELECT * FROM events', 'company': 'Kiwi'}
+    operator = DBtoCSV(task_id='export', incremental_column='created_at')
+    hook = Mock()
+    hook.get_first.side_effect = [(column_type,), (high,)]
+    hook.get_conn.return_value = Mock(spec=connection, encoding='UTF8')
+    operator.get_hook = Mock(return_value=hook)
+    operator.render_template = Mock(return_value='sql2csv')
+    variables = {}
+
+    with patch('airflow_plugins.variables.ValueResolver.get_value',
+               return_value=watermark) as get_value, \
+            patch('airflow_plugins.utils.create_variable',
+                  variables.__setitem__), \
+            patch('airflow_plugins.operators.BashOperator.execute'), \
+            patch.object(sql.Composed, 'as_string',
+                         lambda self, context: render(self)):
+        operator.pre_execute({'params': params})
+        operator.execute({'params': params})
+    return (variables, get_value.call_args[0][0],
+            render(hook.get_first.call_args[0][0]))
+
+
+def test_db_to_csv_incremental_timestamptz_watermark():
+    from airflow_plugins.variables import ValueResolver
+    prague = timezone(timedelta(hours=2))
+    variables, key, query = run_incremental(
+        'timestamp with time zone', datetime(2018, 1, 2, 5, 4, 5,
+                                             tzinfo=prague),
+        datetime(2018, 1, 1))
+
+    assert key == 'export_date'
+    assert 'date_trunc' in query
+    # the naive watermark is compared as UTC
+    assert "created_at > datetime.datetime(2018, 1, 1, 0, 0, " \
+        "tzinfo=datetime.timezone.utc)" in query
+    value = variables['kiwi_adhoc_airflow_export_date']
+    assert value == '2018-01-02T03:04:05'
+    with patch.object(ValueResolver, 'session') as session, \
+            patch('airflow_plugins.variables.value_resolver.Variable'):
+        session.query.return_value.filter.return_value.all.return_value = [
+            Mock(key='export_date', val=value)]
+        assert ValueResolver.get_value('export_date') == \
+            datetime(2018, 1, 2, 3, 4, 5)
+
+
+def test_db_to_csv_incremental_integer_watermark():
+    variables, key, query = run_incremental('integer', 42, '40')
+
+    assert key == 'export_watermark'
+    assert 'date_trunc' not in query
+    assert variables == {'kiwi_adhoc_airflow_export_watermark': '42'}
+
+
+def literals(composable):
+    """Values of psycopg2.sql.Literal parts of the composed statement."""
+    if isinstance(composable, sql.Composed):
+        return [v for part in composable.seq for v in literals(part)]
+    if isinstance(composable, sql.Literal):
+        return [composable.wrapped]
+    return []
+
+
+def test_copy_csv_to_db_loads_appended_tail(tmpdir):
+    path = tmpdir.join('log.csv')
+    path.write('id,text\n1,a\n2,"b\nc"\n')
+    params = {'local_path': str(path), 'table_name': 'log'}
+    operator = CopyCSVtoDB(task_id='load', tail=True, checksum_size=4)
+    loads = []
+    checkpoints = {}
+    failures = []
+
+    def copy(query, f, before=None):
+        data = f.read()
+        if failures:
+            raise failures.pop()
+        # checkpoint is stored by the last statement before the COPY
+        dag_id, task_id, path, offset, checksum = literals(before[-1])
+        checkpoints[dag_id, task_id, path] = (offset, checksum)
+        loads.append((data, 'TRUNCATE' in render(before[0])))
+
+    hook = Mock()
+    hook.copy.side_effect = copy
+    hook.get_first.side_effect = lambda query, parameters: checkpoints.get(
+        parameters)
+    operator.get_hook = Mock(return_value=hook)
+
+    operator.execute({'params': params})
+    path.write('3,"d\n', mode='a')  # incomplete record
+    operator.execute({'params': params})
+    path.write('e"\n4,f\n', mode='a')
+    operator.execute({'params': params})
+    path.write('5,g\n', mode='a')
+    failures.append(ValueError('COPY failed'))
+    with pytest.raises(ValueError):
+        operator.execute({'params': params})
+    operator.execute({'params': params})  # the same tail again
+    path.write('id,text\n9,z\n')  # rewritten file
+    operator.execute({'params': params})
+
+    assert loads == [
+        (b'id,text\n1,a\n2,"b\nc"\n', True),
+        (b'id,text\n3,"d\ne"\n4,f\n', False),
+        (b'id,text\n5,g\n', False),
+        (b'id,text\n9,z\n', True),
+    ]
+    assert 'csv_tail_checkpoints' in hook.run.call_args[0][0]
+
+
+def test_copy_csv_to_db_find_last_record_end():
+    data = b'id,text\n1,"a\nb"\n2,"c\nd""\n"\n3,"e\n'
+    for blocksize in [1, 3, 1024]:
+        def find(start, end):
+            return CopyCSVtoDB._find_last_record_end(
+                io.BytesIO(data), start, end, blocksize=blocksize)
+        assert find(0, len(data)) == data.index(b'3,')
+        assert find(8, len(data)) == data.index(b'3,')
+        assert find(8, data.index(b'2,') - 1) == 8
+        assert find(8, 8) == 8
+
+
+def test_copy_csv_to_db_tail_uses_quotechar(tmpdir):
+    path = tmpdir.join('log.csv')
+    path.write("id,text\n1,'a\nb'\n2,'c\n")  # the last record is open
+    params = {'local_path': str(path), 'table_name': 'log',
+              'extra': "-q \"'\""}
+    operator = CopyCSVtoDB(task_id='load', tail=True)
+    hook = Mock()
+    hook.get_first.return_value = None
+    loaded = []
+    hook.copy.side_effect = lambda query, f, before=None: loaded.append(
+        (f.read(), literals(before[-1])[3]))
+    operator.get_hook = Mock(return_value=hook)
+
+    operator.execute({'params': params})
+    assert loaded == [(b"id,text\n1,'a\nb'\n", 16)]
+
+
+def test_split_csv_to_db_resumes_unfinished_splits(tmpdir):
+    path = tmpdir.join('file.csv')
+    path.write('id\n' + ''.join('{}\n'.format(i) for i in range(30)))
+    context = {'params': {'local_path': str(path), 'table_name': 't'},
+               'execution_date': datetime(2018, 1, 1), 'ti': Mock()}
+    operator = SplitCSVtoDB(task_id='load', resumable=True)
+    hook = Mock()
+    hook.get_free_connections.return_value = 10
+    operator.get_hook = Mock(return_value=hook)
+    loaded = []
+    hook.copy.side_effect = lambda query, f, before=None: loaded.append(
+        (f.read(), len(before)))
+
+    with patch.object(SplitCSVtoDB, '_determine_splits', return_value=3):
+        header_end, ranges = SplitCSVtoDB._split_ranges(str(path), 3)
+        hook.get_records.return_value = [ranges[0]]
+        operator.pre_execute(context)
+        timings = operator.execute(context)
+
+    assert [t.get('skipped', False) for t in timings] == [True, False, False]
+    with open(str(path), 'rb') as f:
+        data = f.read()
+    assert loaded == [(b'id\n' + data[start:end], 1)
+                      for start, end in ranges[1:]]
+    assert hook.get_records.call_args[1]['parameters'] == (
+        'adhoc_airflow', 'load', datetime(2018, 1, 1), str(path), len(data))
+
+
+def test_split_csv_to_db_parallel_caps_workers_and_fails_fast(tmpdir):
+    path = tmpdir.join('file.csv')
+    path.write('id\n' + ''.join('{}\n'.format(i) for i in range(40)))
+    context = {'params': {'local_path': str(path), 'table_name': 't'},
+               'ti': Mock()}
+    operator = SplitCSVtoDB(task_id='load', parallel=8)
+    hook = Mock()
+    hook.get_free_connections.return_value = 2
+    operator.get_hook = Mock(return_value=hook)
+
+    def copy(query, f, before=None):
+        if f.read().startswith(b'id\n0\n'):
+            raise ValueError('COPY failed')
+
+    hook.copy.side_effect = copy
+    with patch.object(SplitCSVtoDB, '_determine_splits', return_value=4), \
+            patch('airflow_plugins.utils.run_parallel',
+                  wraps=utils.run_parallel) as run_parallel:
+        operator.pre_execute(context)
+        with pytest.raises(AirflowException) as e:
+            operator.execute(context)
+
+    assert run_parallel.call_args[0][2] == 2  # capped by free connections
+    assert '1 of 4 task(s) failed: COPY failed' in str(e.value)
+    context['ti'].xcom_push.assert_not_called()
+
+    hook.get_free_connections.side_effect = Exception('no pg_stat_activity')
+    assert operator._get_workers(hook, 8, 3) == 3
+    hook.get_free_connections.side_effect = None
+    hook.get_free_connections.return_value = 0
+    assert operator._get_workers(hook, 8, 3) == 1
+
+
+def test_split_csv_to_db_split_command(tmpdir):
+    path = tmpdir.join('file.csv')
+    rows = ['id,text'] + ["{},'a\n\"b'".format(i) for i in range(30)]
+    path.write('\n'.join(rows) + '\n')
+    output = tmpdir.join('out')
+    context = {'params': {'local_path': str(path), 'extra': "-q \"'\""}}
+    operator = SplitCSVtoDB(task_id='load')
+    # rendered command, csvsql replaced by cat
+    operator.bash_command = 'cat >> {} {}'.format(output, path)
+
+    with patch.object(SplitCSVtoDB, '_determine_splits', return_value=3):
+        operator.pre_execute(context)
+    assert len(operator._ranges) == 3
+    assert operator.bash_command.count('| cat >> {}  -'.format(output)) == 3
+
+    subprocess.check_call(['bash', '-c', operator.bash_command])
+    splits = output.read().split('id,text\n')
+    assert splits[0] == '' and len(splits) == 4
+    assert ''.join(splits[1:]) == '\n'.join(rows[1:]) + '\n'
+    for split in splits[1:]:
+        assert all(len(row) == 2 for row in csv.reader(
+            io.StringIO(split), quotechar="'"))
+
+
+def test_split_csv_to_db_parallel_copies_single_split(tmpdir):
+    path = tmpdir.join('file.csv')
+    path.write('id,text\n1,NA\n2,null\n')
+    context = {'params': {'local_path': str(path), 'table_name': 't'},
+               'ti': Mock()}
+    operator = SplitCSVtoDB(task_id='load', parallel=4)
+    hook = Mock()
+    hook.get_free_connections.return_value = 10
+    operator.get_hook = Mock(return_value=hook)
+    loaded = []
+    hook.copy.side_effect = lambda query, f, before=None: loaded.append(
+        f.read())
+
+    with patch('airflow_plugins.operators.BashOperator.execute') as bash:
+        operator.pre_execute(context)
+        operator.execute(context)
+    bash.assert_not_called()
+    assert loaded == [b'id,text\n1,NA\n2,null\n']
+
+
+def test_split_csv_to_db_loads_checkpoints_by_postgres_hook(tmpdir):
+    path = tmpdir.join('file.csv')
+    path.write('id\n1\n')
+    context = {'params': {'local_path': str(path), 'table_name': 't'},
+               'execution_date': datetime(2018, 1, 1)}
+    operator = SplitCSVtoDB(task_id='load', resumable=True)
+    hook = PostgresHook()
+    conn = Mock(spec=connection, encoding='UTF8')
+    conn.cursor.return_value.fetchall.return_value = [(0, 3)]
+    hook.get_conn = Mock(return_value=conn)
+    operator.get_hook = Mock(return_value=hook)
+
+    assert operator._load_checkpoints(context) == {(0, 3)}
+    statement = conn.cursor.return_value.execute.call_args_list[0][0][0]
+    assert statement.startswith(
+        'CREATE TABLE IF NOT EXISTS split_checkpoints (')
+
+
+def test_split_csv_to_db_loads_partitions(tmpdir):
+    path = tmpdir.join('file.csv')
+    path.write('id,name\n5,a\n50,b\n,c\n7,d\n')
+    context = {'params': {'local_path': str(path), 'table_name': 't'},
+               'ti': Mock()}
+    operator = SplitCSVtoDB(task_id='load', partition_column='id',
+                            partition_by='range', partition_bounds=[10])
+    hook = Mock()
+    hook.get_first.return_value = ('integer',)
+    hook.get_free_connections.return_value = 10
+    operator.get_hook = Mock(return_value=hook)
+    loaded = {}
+
+    def copy(table, f, before=None):
+        loaded[table] = f.read()
+
+    hook.copy.side_effect = copy
+    with patch.object(SplitCSVtoDB, '_copy_sql',
+                      side_effect=lambda table, *args: table):
+        operator.pre_execute(context)
+        operator.execute(context)
+
+    assert loaded == {
+        't_p0': b'id,name\r\n5,a\r\n7,d\r\n',
+        't_p1': b'id,name\r\n50,b\r\n',
+        't_default': b'id,name\r\n,c\r\n',
+    }
+    assert not tmpdir.join('file.csv').dirpath().listdir(
+        lambda p: p.check(dir=True))
+
+
+def test_split_csv_to_db_partitions_reject_short_records(tmpdir):
+    path = tmpdir.join('file.csv')
+    path.write('name,id\na,5\nb\n')
+    context = {'params': {'local_path': str(path), 'table_name': 't'},
+               'ti': Mock()}
+    operator = SplitCSVtoDB(task_id='load', partition_column='id',
+                            partition_by='range', partition_bounds=[10])
+    hook = Mock()
+    hook.get_first.return_value = ('integer',)
+    operator.get_hook = Mock(return_value=hook)
+
+    with pytest.raises(AirflowException) as e:
+        operator.execute(context)
+    assert 'line 3' in str(e.value)
+    hook.copy.assert_not_called()
+    assert not tmpdir.listdir(lambda p: p.check(dir=True))
+
+
+def test_csv_stats_stream_engine(tmpdir):
+    path = tmpdir.join('file.csv')
+    path.write('a;b\n1;x\n3;\n')
+    operator = CSVStats(task_id='stats', engine='stream', quantiles=[0.5])
+
+    stats = operator.execute({'params': {'path': str(path),
+                                         'delimiter': ';'}})
+    assert stats[0] == {'column': 'a', 'type': 'Number', 'count': 2,
+                        'nulls': 0, 'distinct': 2, 'min': 1.0, 'max': 3.0,
+                        'mean': 2.0, 'quantiles': {'0.5': 1.0}}
+    assert stats[1]['nulls'] == 1
+
+
+@pytest.mark.parametrize('parallel', [None, 2])
+def test_csv_stats_stream_engine_uses_extra_dialect(tmpdir, parallel):
+    path = tmpdir.join('file.csv')
+    path.write_binary(u'\ufeffid;name\n1;\'a\n;b\'\n2;c\n3;d\n'.encode(
+        'utf-8'))
+    operator = CSVStats(task_id='stats', engine='stream', quantiles=[0.5],
+                        parallel=parallel)
+
+    stats = operator.execute({'params': {'path': str(path),
+                                         'extra': "-d ';' -q \"'\""}})
+    assert [column['column'] for column in stats] == ['id', 'name']
+    assert stats[0]['count'] == 3 and stats[0]['max'] == 3.0
+    assert stats[1]['min'] == 'a\n;b'
+
+
+def test_load_uses_extra_dialect_and_strips_bom(tmpdir):
+    path = tmpdir.join('file.csv')
+    path.write_binary(u'\ufeffid;"na;me"\n1;a\n'.encode('utf-8'))
+    params = {'local_path': str(path), 'table_name': 't',
+              'extra': "-d ';' -e latin1"}
+    hook = Mock()
+    CopyCSVtoDB._load(hook, dict(params, encoding='utf-8'), str(path))
+
+    query = hook.copy.call_args[0][0]
+    fields = query.seq[3]
+    assert [f.string for f in fields.seq[::2]] == ['id', 'na;me']
+    assert [part.wrapped for part in query.seq
+            if isinstance(part, sql.Literal)] == [';', '"', 'UTF8']
+    assert CopyCSVtoDB._get_dialect(params) == ({'delimiter': ';'},
+                                                'latin1')
+    assert CopyCSVtoDB._pg_encoding('latin1') == 'LATIN1'
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_copy_db_to_csv_export(tmpdir, compress):
+    path = tmpdir.join('out.csv.gz' if compress else 'out.csv')
+    params = {'query': 'SELECT * FROM t;\n', 'delimiter': ';',
+              'output_path_temp': str(path)}
+    operator = CopyDBtoCSV(task_id='export', compress=compress)
+    hook = Mock()
+
+    def copy(query, f, before=None):
+        f.write(b'id;name\n1;a\n')
+        return 1
+
+    hook.copy.side_effect = copy
+    operator.get_hook = Mock(return_value=hook)
+    operator.execute({'params': params})
+
+    assert render(hook.copy.call_args[0][0]) == (
+        "COPY (SELECT * FROM t) TO STDOUT WITH "
+        "(FORMAT csv, HEADER true, DELIMITER ';')")
+    opener = gzip.open if compress else open
+    with opener(str(path), mode='rb') as f:
+        assert f.read() == b'id;name\n1;a\n'
+
+    CopyDBtoCSV._export(hook, params, str(path), header=False)
+    assert 'HEADER false' in render(hook.copy.call_args[0][0])
+
+
+def test_load_binary_format(tmpdir):
+    path = tmpdir.join('file.csv')
+    path.write_binary(u'\ufeffid;name;day\n1;"a;b";2000-01-02\n'
+                      u'2;;\n3;c;1999-12-31\n'.encode('utf-8'))
+    params = {'local_path': str(path), 'table_name': 't', 'delimiter': ';'}
+    hook = Mock()
+    hook.get_records.return_value = [
+        ('day', 'date'), ('id', 'integer'), ('name', 'text'), ('x', 'text')]
+    loaded = []
+    hook.copy.side_effect = lambda query, f, before=None: loaded.append(
+        f.read(1024 * 1024))
+
+    with open(str(path), 'rb') as f:
+        data = f.read()
+    start = data.index(b'3;')
+    CopyCSVtoDB._load(hook, params, str(path), format='binary',
+                      ranges=[(0, data.index(b'1;')), (start, len(data))])
+
+    assert render(hook.copy.call_args[0][0]) == (
+        'COPY t ("id", "name", "day") FROM STDIN (FORMAT binary)')
+    assert hook.get_records.call_args[1]['parameters'] == ('t',)
+    assert loaded == [
+        b'PGCOPY\n\xff\r\n\x00' + b'\x00' * 8
+        + struct.pack('!hii', 3, 4, 3) + struct.pack('!i', 1) + b'c'
+        + struct.pack('!iih', 4, -1, -1)]
+
+    loaded[:] = []
+    CopyCSVtoDB._load(hook, params, str(path), format='binary')
+    rows = loaded[0][19:-2]
+    assert rows.startswith(struct.pack('!hii', 3, 4, 1) +
+                           struct.pack('!i', 3) + b'a;b')
+    # empty values are NULLs, as in the CSV COPY
+    assert struct.pack('!hiiii', 3, 4, 2, -1, -1) in rows
+
+    hook.get_records.return_value = [('id', 'integer')]
+    with pytest.raises(AirflowException):
+        CopyCSVtoDB._load(hook, params, str(path), format='binary')
+    with pytest.raises(ValueError):
+        CopyCSVtoDB._load(hook, params, str(path), format='text')
+
+
+def test_copy_db_to_csv_interpolates_bounds():
+    assert CopyDBtoCSV._interpolate(0, 10, 4) == [0, 2, 5, 7, 10]
+    assert CopyDBtoCSV._interpolate(date(2018, 1, 1), date(2018, 1, 5),
+                                    2) == [date(2018, 1, 1), date(2018, 1, 3),
+                                           date(2018, 1, 5)]
+
+
+def test_copy_db_to_csv_bounds():
+    operator = CopyDBtoCSV(task_id='export', partition_column='id',
+                           partitions=4)
+    hook = Mock()
+    query = sql.SQL('SELECT * FROM t')
+
+    hook.get_first.return_value = (0, 1)
+    assert operator._get_bounds(hook, query) == [0, 1]  # deduplicated
+    assert render(hook.get_first.call_args[0][0]) == (
+        'SELECT min("id"), max("id") FROM (SELECT * FROM t) q')
+    hook.get_first.return_value = (None, None)
+    assert operator._get_bounds(hook, query) == []
+
+    operator.partition_bounds = 'percentile'
+    hook.get_first.return_value = ([3, 1, 3, 8, 9],)
+    assert operator._get_bounds(hook, query) == [1, 3, 8, 9]
+    assert render(hook.get_first.call_args[0][0]) == (
+        'SELECT percentile_disc([0.0, 0.25, 0.5, 0.75, 1.0]::float[]) '
+        'WITHIN GROUP (ORDER BY "id") FROM (SELECT * FROM t) q')
+
+
+def test_copy_db_to_csv_partition_queries():
+    operator = CopyDBtoCSV(task_id='export', partition_column='id',
+                           partitions=3)
+    query = sql.SQL('SELECT * FROM t')
+    queries = [render(q) for q in operator._partition_queries(
+        query, [0, 5, 10, 20])]
+    assert queries == [
+        'SELECT * FROM (SELECT * FROM t) q WHERE "id" < 5 OR "id" IS NULL',
+        'SELECT * FROM (SELECT * FROM t) q WHERE "id" >= 5 AND "id" < 10',
+        'SELECT * FROM (SELECT * FROM t) q WHERE "id" >= 10',
+    ]
+    assert operator._partition_queries(query, []) == [query]
+    assert operator._partition_queries(query, [0, 20]) == [query]
+
+
+@pytest.mark.parametrize('fail', [False, True])
+def test_copy_db_to_csv_parallel_shares_snapshot(tmpdir, fail):
+    path = tmpdir.join('out.csv')
+    params = {'query': 'SELECT * FROM t', 'output_path_temp': str(path)}
+    operator = CopyDBtoCSV(task_id='export', partition_column='id',
+                           partitions=3)
+    hook = Mock()
+    hook.get_first.return_value = (0, 30)
+    hook.get_free_connections.return_value = 10
+    conn = hook.get_conn.return_value
+    conn.cursor.return_value.fetchone.return_value = ('00000003-1',)
+    operator.get_hook = Mock(return_value=hook)
+    snapshots = []
+
+    def copy(query, f, before=None):
+        snapshots.append([render(statement) for statement in before])
+        header = b'id\n' if 'HEADER true' in render(query) else b''
+        if fail and '"id" >= 20' in render(query):
+            raise ValueError('COPY failed')
+        f.write(header + b'1\n')
+        return 1
+
+    hook.copy.side_effect = copy
+    if fail:
+        with pytest.raises(AirflowException):
+            operator.execute({'params': params})
+    else:
+        operator.execute({'params': params})
+        assert path.read() == 'id\n1\n1\n1\n'
+
+    assert [c[0][0] for c in conn.cursor.return_value.execute.call_args_list
+            ] == ['SET TRANSACTION ISOLATION LEVEL REPEATABLE READ',
+                  'SELECT pg_export_snapshot()']
+    assert snapshots[0] == [
+        'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ',
+        "SET TRANSACTION SNAPSHOT '00000003-1'"]
+    assert all(s == snapshots[0] for s in snapshots)
+    conn.rollback.assert_called_once_with()
+    hook.release_conn.assert_called_once_with(conn)
+    assert tmpdir.listdir() == ([] if fail else [path])
+
+
+def test_upsert_merge_sql():
+    operator = UpsertCSVtoDB(task_id='upsert', key_columns=['id'])
+    merge, delete = operator._merge_sql('t', 'staging_t',
+                                        ['id', 'a', 'b'])
+    assert render(merge) == (
+        'INSERT INTO t AS t ("id", "a", "b") '
+        'SELECT DISTINCT ON ("id") "id", "a", "b" FROM "staging_t" '
+        'ORDER BY "id", ctid DESC ON CONFLICT ("id") '
+        'DO UPDATE SET ("a", "b") = (EXCLUDED."a", EXCLUDED."b") '
+        'WHERE (t."a", t."b") IS DISTINCT FROM (EXCLUDED."a", EXCLUDED."b")')
+    assert render(delete) == (
+        'DELETE FROM t t WHERE NOT EXISTS '
+        '(SELECT 1 FROM "staging_t" s WHERE s."id" = t."id")')
+
+    merge, _ = operator._merge_sql('t', 'staging_t', ['id', 'a'])
+    assert render(merge).endswith(
+        'ON CONFLICT ("id") DO UPDATE SET "a" = EXCLUDED."a" '
+        'WHERE t."a" IS DISTINCT FROM EXCLUDED."a"')
+
+    operator.key_columns = ['id', 'a']
+    merge, delete = operator._merge_sql('t', 'staging_t', ['id', 'a'])
+    assert render(merge).endswith(
+        'ORDER BY "id", "a", ctid DESC ON CONFLICT ("id", "a") DO NOTHING')
+    assert render(delete).endswith(
+        'WHERE s."id" = t."id" AND s."a" = t."a")')
+
+
+def test_upsert_copies_into_quoted_staging_table(tmpdir):
+    path = tmpdir.join('file.csv')
+    path.write('id,a\n1,x\n')
+    params = {'local_path': str(path), 'table_name': '"Orders"'}
+    operator = UpsertCSVtoDB(task_id='upsert', key_columns=['id'])
+    hook = Mock()
+    conn = hook.get_conn.return_value
+    cur = conn.cursor.return_value
+    operator.get_hook = Mock(return_value=hook)
+
+    with patch.object(sql.Composed, 'as_string',
+                      lambda self, context: render(self)):
+        operator.execute({'params': params})
+
+    assert render(cur.execute.call_args_list[0][0][0]) == (
+        'CREATE TEMPORARY TABLE "staging_Orders" '
+        '(LIKE "Orders" INCLUDING DEFAULTS) ON COMMIT DROP')
+    assert cur.copy_expert.call_args[0][0].startswith(
+        'COPY "staging_Orders" ("id", "a") FROM STDIN')
+    conn.commit.assert_called_once_with()
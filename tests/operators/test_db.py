@@ -1,8 +1,27 @@
+import gzip
 import os
+import shutil
+import struct
+from contextlib import closing
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
 
 import pytest
+from mock import Mock, patch
+from psycopg2 import sql
 
+from airflow.exceptions import AirflowException
 from airflow_plugins.operators import CreateTableWithColumns
+from airflow_plugins.operators.db import (
+    BinaryCopyEncoder,
+    ConnectionPool,
+    CopyTable,
+    CreateDatabase,
+    CreateTablesWithColumns,
+    PartitionScheme,
+    PostgresHook
+)
+from tests.utils import render
 
 
 @pytest.mark.parametrize(
@@ -23,3 +42,737 @@ def test_create_table_with_columns(file_name, known_columns):
     assert len(known_columns) == len(columns)
     for i in range(len(known_columns)):
         assert known_columns[i] == columns[i]
+
+
+def test_create_table_with_columns_reads_gzip_header(tmpdir):
+    file = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                        'test_db_columns.csv')
+    gzip_file = str(tmpdir.join('columns.csv.gz'))
+    with open(file, mode='rb') as src, gzip.open(gzip_file, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+
+    get_columns = CreateTableWithColumns._get_table_columns
+    assert get_columns(gzip_file, block_size=64) == get_columns(file)
+
+
+def test_create_table_with_columns_bounds_gzip_sample(tmpdir):
+    gzip_file = str(tmpdir.join('big.csv.gz'))
+    with gzip.open(gzip_file, 'wb') as f:
+        f.write(b'id\n' + b'1\n' * 1024 * 1024)
+
+    data, eof = CreateTableWithColumns._read_head(gzip_file, 1024)
+    assert len(data) == 1024 and not eof
+    data, eof = CreateTableWithColumns._read_head(gzip_file, 4 * 1024 * 1024)
+    assert len(data) == 2 * 1024 * 1024 + 3 and eof
+
+
+def test_create_table_with_columns_reads_ftp_header_in_binary_mode():
+    ftp = Mock()
+    ftp.transfercmd.return_value.recv.side_effect = [b'id,name\n', b'']
+    with patch('airflow_plugins.hooks.FTPHook') as hook:
+        hook.return_value.get_conn.return_value = ftp
+        assert CreateTableWithColumns._read_block(
+            'ftp://ftp_conn/data/file.csv', 1024) == b'id,name\n'
+    hook.assert_called_once_with('ftp_conn')
+    assert ftp.method_calls[:2] == [
+        ('voidcmd', ('TYPE I',), {}),
+        ('transfercmd', ('RETR /data/file.csv',), {})]
+
+
+def test_create_table_with_columns_missing_s3_file():
+    with patch('airflow.hooks.S3_hook.S3Hook') as hook:
+        hook.return_value.get_bucket.return_value.get_key.return_value = None
+        with pytest.raises(AirflowException) as e:
+            CreateTableWithColumns._read_block('s3://bucket/file.csv', 1024)
+    assert 's3://bucket/file.csv' in str(e.value)
+
+
+def test_connection_pool_reuses_idle_connections():
+    pool = ConnectionPool(max_size=1)
+    conn = Mock(closed=0)
+    conn.get_transaction_status.return_value = 0
+    connect = Mock(side_effect=[conn, Mock(closed=0)])
+
+    assert pool.get('key', connect) is conn
+    pool.put('key', conn)
+    conn.cursor.return_value.execute.assert_called_once_with('DISCARD ALL;')
+    assert conn.autocommit is False
+    assert pool.get('key', connect) is conn
+    assert connect.call_count == 1
+
+    pool.put('key', conn)
+    pool.put('key', Mock(closed=0))  # over max_size, gets closed
+    assert len(pool._idle['key']) == 1
+
+
+def test_connection_pool_drops_expired_connections():
+    pool = ConnectionPool(idle_timeout=0)
+    conn = Mock(closed=0)
+    conn.get_transaction_status.return_value = 0
+    pool.put('key', conn)
+
+    new_conn = Mock()
+    assert pool.get('key', lambda: new_conn) is new_conn
+    conn.close.assert_called_once_with()
+
+
+def test_postgres_hook_resolves_connection_once():
+    hook = PostgresHook(database='db', pooled=False)
+    hook.get_connection = Mock(return_value=Mock(
+        host='host', login='user', password='secret', schema='other',
+        port=5432, extra_dejson={'sslmode': 'require', 'pool': True}))
+
+    with patch('airflow_plugins.operators.db.psycopg2.connect') as connect:
+        connect.return_value.server_version = 100000
+        hook.get_conn()
+        hook.get_conn()
+    hook.get_connection.assert_called_once_with('postgres_default')
+    assert connect.call_args_list == [
+        ((), dict(host='host', user='user', password='secret', dbname='db',
+                  port=5432, sslmode='require'))] * 2
+
+
+def test_postgres_hook_batch_run():
+    hook = PostgresHook(batch=True)
+    conn = Mock()
+    hook.get_conn = Mock(return_value=conn)
+
+    hook.run(['CREATE TABLE a (id INT)', 'CREATE TABLE b (id INT);',
+              'CREATE TABLE c (id INT) -- no b;', 'DROP TABLE d; -- old'])
+    cur = conn.cursor.return_value
+    cur.execute.assert_called_once_with(
+        'CREATE TABLE a (id INT)\n;\nCREATE TABLE b (id INT);\n'
+        'CREATE TABLE c (id INT) -- no b;\n;\nDROP TABLE d; -- old\n;',
+        None)
+    conn.commit.assert_called_once_with()
+
+
+def test_postgres_hook_batch_run_failure_releases_connection():
+    hook = PostgresHook(batch=True)
+    conn = Mock()
+    cur = conn.cursor.return_value
+    cur.execute.side_effect = ValueError('syntax error')
+    hook.get_conn = Mock(return_value=conn)
+    hook.release_conn = Mock()
+
+    with pytest.raises(ValueError):
+        hook.run(['CREATE TABLE a (id INT);'])
+    conn.commit.assert_not_called()
+    conn.rollback.assert_called_once_with()
+    cur.close.assert_called_once_with()
+    hook.release_conn.assert_called_once_with(conn)
+
+
+def test_postgres_hook_batch_run_with_parameters():
+    hook = PostgresHook(batch=True)
+    conn = Mock()
+    hook.get_conn = Mock(return_value=conn)
+
+    hook.run(['DELETE FROM a WHERE id = %s', 'DELETE FROM b WHERE id = %s'],
+             parameters=(1,))
+    cur = conn.cursor.return_value
+    assert [c[0] for c in cur.execute.call_args_list] == [
+        ('DELETE FROM a WHERE id = %s', (1,)),
+        ('DELETE FROM b WHERE id = %s', (1,)),
+    ]
+    conn.commit.assert_called_once_with()
+
+
+def test_postgres_hook_batch_run_fail_silently():
+    hook = PostgresHook(batch=True, fail_silently=True)
+    conn = Mock()
+    cur = conn.cursor.return_value
+    cur.execute.side_effect = [Exception('exists'), None, None]
+    hook.get_conn = Mock(return_value=conn)
+
+    hook.run(['CREATE TABLE a (id INT);', 'CREATE TABLE b (id INT);'])
+    assert [c[0][0] for c in cur.execute.call_args_list] == [
+        'SAVEPOINT batch_statement; CREATE TABLE a (id INT);',
+        'ROLLBACK TO SAVEPOINT batch_statement;',
+        'RELEASE SAVEPOINT batch_statement; SAVEPOINT batch_statement; '
+        'CREATE TABLE b (id INT);',
+    ]
+    conn.commit.assert_called_once_with()
+
+
+def test_postgres_hook_insert_rows():
+    hook = PostgresHook()
+    conn = Mock()
+    hook.get_conn = Mock(return_value=conn)
+    rows = iter([(i, str(i)) for i in range(5)])
+
+    with patch('airflow_plugins.operators.db.extras') as extras:
+        assert hook.insert_rows('t', rows, commit_every=2, page_size=10) == 5
+    cur = conn.cursor.return_value
+    assert extras.execute_values.call_args_list == [
+        ((cur, 'INSERT INTO t VALUES %s', chunk), {'page_size': 10})
+        for chunk in [[(0, '0'), (1, '1')], [(2, '2'), (3, '3')],
+                      [(4, '4')]]]
+    extras.execute_batch.assert_not_called()
+    assert conn.commit.call_count == 3
+    cur.close.assert_called_once_with()
+
+
+def test_postgres_hook_insert_rows_batch():
+    hook = PostgresHook()
+    conn = Mock()
+    hook.get_conn = Mock(return_value=conn)
+
+    with patch('airflow_plugins.operators.db.extras') as extras:
+        assert hook.insert_rows('t', [(1, 'a'), (2, 'b')],
+                                method='batch') == 2
+    extras.execute_batch.assert_called_once_with(
+        conn.cursor.return_value, 'INSERT INTO t VALUES (%s, %s)',
+        [(1, 'a'), (2, 'b')], page_size=1000)
+    extras.execute_values.assert_not_called()
+    conn.commit.assert_called_once_with()
+
+
+def test_postgres_hook_insert_rows_failure():
+    hook = PostgresHook()
+    conn = Mock()
+    hook.get_conn = Mock(return_value=conn)
+    hook.release_conn = Mock()
+
+    with patch('airflow_plugins.operators.db.extras') as extras:
+        extras.execute_values.side_effect = [None, ValueError('bad row')]
+        with pytest.raises(ValueError):
+            hook.insert_rows('t', [(1,), (2,)], commit_every=1)
+    conn.commit.assert_called_once_with()  # the first chunk only
+    conn.rollback.assert_called_once_with()
+    hook.release_conn.assert_called_once_with(conn)
+
+    with pytest.raises(ValueError):
+        hook.insert_rows('t', [(1,)], method='copy')
+    assert hook.get_conn.call_count == 1
+
+
+def test_postgres_hook_iter_records():
+    hook = PostgresHook()
+    conn = Mock()
+    cur = conn.cursor.return_value
+    cur.__iter__ = Mock(return_value=iter([(1,), (2,), (3,)]))
+    hook.get_conn = Mock(return_value=conn)
+    hook.release_conn = Mock()
+
+    with closing(hook.iter_records('SELECT id FROM t', itersize=2)) as rows:
+        assert next(rows) == (1,)
+        assert cur.itersize == 2
+        hook.release_conn.assert_not_called()
+    # stopped early, released when the generator is closed
+    cur.close.assert_called_once_with()
+    conn.rollback.assert_called_once_with()
+    hook.release_conn.assert_called_once_with(conn)
+
+    cur.__iter__ = Mock(return_value=iter([(1,), (2,)]))
+    assert list(hook.iter_records('SELECT id FROM t')) == [(1,), (2,)]
+    assert hook.release_conn.call_count == 2
+
+
+def test_postgres_hook_iter_batches():
+    hook = PostgresHook()
+    conn = Mock()
+    cur = conn.cursor.return_value
+    cur.description = [('id',), ('name',)]
+    cur.fetchmany.side_effect = [[(1, 'a'), (2, 'b')], [(3, 'c')], []]
+    hook.get_conn = Mock(return_value=conn)
+
+    batches = list(hook.iter_batches('SELECT id, name FROM t', batch_size=2,
+                                     columns=True))
+    assert batches == [
+        {'id': [1, 2], 'name': ['a', 'b']},
+        {'id': [3], 'name': ['c']},
+    ]
+    assert conn.cursor.call_args[1]['name'].startswith('iter_')
+    cur.close.assert_called_once_with()
+
+
+def test_postgres_hook_instrumentation():
+    hook = PostgresHook(instrument=True, explain='plan', slow_threshold=0)
+    conn = Mock()
+    conn.autocommit = False
+    cur = conn.cursor.return_value
+    cur.connection = conn
+    cur.rowcount = 5
+    cur.fetchall.return_value = [('Seq Scan on t',)]
+    hook.get_conn = Mock(return_value=conn)
+
+    hook.run(['UPDATE t SET a = 1;', 'CREATE INDEX ON t (a);'])
+    assert [s['sql'] for s in hook.statement_stats] == [
+        'UPDATE t SET a = 1;', 'CREATE INDEX ON t (a);']
+    assert hook.statement_stats[0]['rowcount'] == 5
+    assert hook.statement_stats[0]['plan'] == 'Seq Scan on t'
+    assert hook.statement_stats[1]['plan'] is None
+
+
+def test_postgres_hook_explain_analyze_rowcount():
+    hook = PostgresHook(instrument=True, explain='analyze')
+    conn = Mock()
+    cur = conn.cursor.return_value
+    cur.rowcount = 3  # lines of the plan
+    cur.fetchall.side_effect = [
+        [('Seq Scan on t  (cost=0.00..1.10 rows=10 width=4) '
+          '(actual time=0.010..0.020 rows=7 loops=1)',), ('Planning...',)],
+        [('Update on t  (cost=0.00..1.10 rows=10 width=10) '
+          '(actual time=0.050..0.050 rows=0 loops=1)',),
+         ('  ->  Seq Scan on t  (cost=0.00..1.10 rows=10 width=10) '
+          '(actual time=0.010..0.020 rows=9 loops=1)',),
+         ('        Filter: (a <> 1)',)],
+        [('Insert on t  (cost=0.00..0.01 rows=1 width=4) '
+          '(actual time=0.030..0.030 rows=0 loops=1)',),
+         ('  Conflict Resolution: NOTHING',),
+         ('  Tuples Inserted: 2',),
+         ('  ->  Values Scan on "*VALUES*"  (cost=0.00..0.03 rows=2 '
+          'width=4) (actual time=0.001..0.002 rows=2 loops=1)',)],
+    ]
+    hook.get_conn = Mock(return_value=conn)
+
+    hook.run(['SELECT * FROM t;', 'UPDATE t SET a = 1;',
+              'INSERT INTO t VALUES (1), (2) ON CONFLICT DO NOTHING;'])
+    assert [s['rowcount'] for s in hook.statement_stats] == [7, 9, 2]
+    assert cur.execute.call_args_list[0][0][0] == (
+        'EXPLAIN (ANALYZE, BUFFERS) SELECT * FROM t;')
+
+
+def test_postgres_hook_batch_is_not_explained():
+    hook = PostgresHook(batch=True, instrument=True, explain='analyze')
+    conn = Mock()
+    cur = conn.cursor.return_value
+    cur.rowcount = -1
+    hook.get_conn = Mock(return_value=conn)
+
+    hook.run(['UPDATE t SET a = 1;', 'CREATE INDEX ON t (a);'])
+    cur.execute.assert_called_once_with(
+        'UPDATE t SET a = 1;\nCREATE INDEX ON t (a);', None)
+    assert hook.statement_stats[0]['plan'] is None
+    cur.fetchall.assert_not_called()
+
+
+def test_create_table_with_columns_infers_types():
+    file = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                        'test_db_columns.csv')
+    types = CreateTableWithColumns._infer_column_types(file)
+    assert types[:8] == [
+        'DATE', 'INTEGER', 'INTEGER', 'INTEGER', 'INTEGER', 'INTEGER',
+        'BOOLEAN', 'TEXT']
+    assert types[19] == 'NUMERIC'  # AT_sales
+
+
+def test_create_table_with_columns_validates_timestamps():
+    is_timestamp = dict(CreateTableWithColumns._column_types)['TIMESTAMP']
+    assert is_timestamp('2020-01-01 23:59')
+    assert is_timestamp('2020-01-01T23:59:59.123456')
+    assert not is_timestamp('2020-01-01 25:99')
+    assert not is_timestamp('2020-01-01 12:00:61')
+    assert not is_timestamp('2020-02-30 12:00')
+
+
+def test_create_database_plans_only_missing_statements():
+    op = CreateDatabase(task_id='create_database')
+    op.database_name, op.owner, op.user = 'acme_db', 'admin', 'acme'
+    op.password, op.template = 'secret', None
+
+    assert len(op._plan((False, False, None, []))) == 6
+    assert op._plan((True, True, [
+        'client_encoding=utf8',
+        'default_transaction_isolation=read committed',
+        'TimeZone=UTC',
+    ], ['CREATE', 'CONNECT', 'TEMPORARY'])) == []
+
+
+def test_create_database_plans_template_clone():
+    op = CreateDatabase(task_id='create_database')
+    op.database_name, op.owner, op.user = 'acme_db', 'admin', 'admin'
+    op.password, op.template = None, 'Template_DB'
+
+    assert [render(s) for s in op._plan((False, True, None, []))] == [
+        "SELECT pg_terminate_backend(pid) FROM pg_stat_activity "
+        "WHERE datname = 'template_db' AND pid <> pg_backend_pid() "
+        "AND state LIKE 'idle%';",
+        'CREATE DATABASE acme_db TEMPLATE Template_DB;',
+    ]
+    assert op._plan((True, True, None, [
+        'CREATE', 'CONNECT', 'TEMPORARY'])) == []
+
+
+def test_binary_copy_encoder():
+    encoder = BinaryCopyEncoder(
+        ['integer', 'bigint', 'double precision', 'boolean', 'text', 'date',
+         'timestamp'],
+        [(1, '2', 0.5, 'true', u'\u017e', date(2000, 1, 2),
+          datetime(2000, 1, 1, 0, 0, 1)),
+         ('3', None, '1.5', False, 'x', '1999-12-31', '2000-01-01 00:01')])
+    data = encoder.read(10) + encoder.read()
+
+    assert data.startswith(b'PGCOPY\n\xff\r\n\x00' + b'\x00' * 8)
+    assert data.endswith(b'\xff\xff')
+    assert encoder.rowcount == 2
+    assert encoder.read() == b''
+
+    rows = data[19:-2]
+    first = struct.pack('!hiiiqidi?', 7, 4, 1, 8, 2, 8, 0.5, 1, True)
+    first += struct.pack('!i', 2) + u'\u017e'.encode('utf-8')
+    first += struct.pack('!iiiq', 4, 1, 8, 1000000)
+    second = struct.pack('!hiiiid', 7, 4, 3, -1, 8, 1.5)
+    second += struct.pack('!i?', 1, False) + struct.pack('!i', 1) + b'x'
+    second += struct.pack('!iiiq', 4, -1, 8, 60000000)
+    assert rows == first + second
+
+
+def test_binary_copy_encoder_empty_values():
+    encoder = BinaryCopyEncoder(['integer', 'date', 'boolean', 'text'])
+    assert encoder.encode_row(['', '', '', '']) == struct.pack(
+        '!hiiii', 4, -1, -1, -1, 0)
+
+
+def test_binary_copy_encoder_timestamptz():
+    encoder = BinaryCopyEncoder(['timestamptz', 'timestamp with time zone'])
+    prague = timezone(timedelta(hours=2))
+    assert encoder.encode_row([
+        '2000-01-01 02:00:01+02', datetime(2000, 1, 1, 2, tzinfo=prague),
+    ]) == struct.pack('!hiqiq', 2, 8, 1000000, 8, 0)
+    assert encoder.encode_row([
+        '2000-01-01T00:01:00.5Z', '1999-12-31 19:30-04:30',
+    ]) == struct.pack('!hiqiq', 2, 8, 60500000, 8, 0)
+    for naive in ['2000-01-01 00:00', datetime(2000, 1, 1)]:
+        with pytest.raises(ValueError):
+            encoder.encode_row([naive, None])
+    # offsets of timestamp without time zone values are dropped
+    assert BinaryCopyEncoder(['timestamp']).encode_row(
+        ['2000-01-01 01:00+01:00']) == struct.pack('!hiq', 1, 8, 3600000000)
+    assert BinaryCopyEncoder(['timestamp']).encode_row(
+        [datetime(2000, 1, 1, 1, tzinfo=prague)]) == struct.pack(
+        '!hiq', 1, 8, 3600000000)
+
+
+def test_binary_copy_encoder_boolean():
+    encoder = BinaryCopyEncoder(['boolean'])
+    for value in ['t', 'TRUE', ' yes ', 'Y', 'on', '1', True, 1]:
+        assert encoder.encode_row([value]) == b'\x00\x01' + struct.pack(
+            '!ib', 1, 1)
+    for value in ['f', 'False', 'no', 'N', 'OFF', '0', False, 0]:
+        assert encoder.encode_row([value]) == b'\x00\x01' + struct.pack(
+            '!ib', 1, 0)
+    for value in ['2', 'nope', 'o']:
+        with pytest.raises(ValueError):
+            encoder.encode_row([value])
+
+
+def test_binary_copy_encoder_rejects_unknown_type():
+    with pytest.raises(ValueError):
+        BinaryCopyEncoder(['numeric'])
+
+
+def test_partition_scheme_range():
+    scheme = PartitionScheme('id', 'range', bounds=[100, 10])
+    assert scheme.get_create_sql('t') == [
+        'CREATE TABLE t_p0 PARTITION OF t FOR VALUES '
+        'FROM (MINVALUE) TO (10);',
+        'CREATE TABLE t_p1 PARTITION OF t FOR VALUES FROM (10) TO (100);',
+        'CREATE TABLE t_p2 PARTITION OF t FOR VALUES '
+        'FROM (100) TO (MAXVALUE);',
+        'CREATE TABLE t_default PARTITION OF t DEFAULT;',
+    ]
+    assert [scheme.route(v) for v in ['-5', '10', '99', '100', None]] == [
+        0, 1, 1, 2, 3]
+
+
+def test_partition_scheme_range_typed_bounds():
+    scheme = PartitionScheme('price', 'range', bounds=[Decimal('10.5'), 2.5])
+    assert [scheme.route(v) for v in ['1', '2.5', '10.49', '10.5', '1e3']
+            ] == [0, 1, 1, 2, 2]
+    scheme = PartitionScheme('day', 'range', bounds=[date(2018, 1, 1)])
+    assert [scheme.route(v) for v in ['2017-12-31', '2018-01-01']] == [0, 1]
+    scheme = PartitionScheme('at', 'range',
+                             bounds=[datetime(2018, 1, 1, 12)])
+    assert [scheme.route(v) for v in ['2018-01-01 11:59:59',
+                                      '2018-01-01T12:00']] == [0, 1]
+
+
+def test_partition_scheme_hash():
+    scheme = PartitionScheme('id', 'hash', partitions=4,
+                             column_type='bigint')
+    assert scheme.get_names('t') == ['t_p0', 't_p1', 't_p2', 't_p3']
+    assert scheme.get_create_sql('t')[1] == (
+        'CREATE TABLE t_p1 PARTITION OF t FOR VALUES WITH '
+        '(MODULUS 4, REMAINDER 1);')
+    routes = [scheme.route(str(i)) for i in range(1000)]
+    assert set(routes) == {0, 1, 2, 3}
+    # integer types hash alike, NULLs go to remainder 0
+    assert routes == [PartitionScheme('id', column_type='integer').route(
+        str(i)) for i in range(1000)]
+    assert scheme.route(None) == 0
+    with pytest.raises(ValueError):
+        PartitionScheme('id', column_type='numeric').route('1')
+
+
+# remainders from satisfies_hash_partition() of PostgreSQL 16.2
+@pytest.mark.parametrize(['column_type', 'value', 'remainders'], [
+    ('integer', '0', (0, 4)),
+    ('integer', '1', (0, 5)),
+    ('integer', '-1', (1, 0)),
+    ('integer', '42', (2, 0)),
+    ('bigint', '4294967296', (0, 5)),
+    ('bigint', '-9223372036854775808', (3, 0)),
+    ('text', '', (2, 1)),
+    ('text', 'a', (2, 3)),
+    ('text', 'Praha', (3, 2)),
+    ('text', 'xxxxxxxxxxxx', (0, 2)),
+    ('text', u'\u017elu\u0165ou\u010dk\xfd k\u016f\u0148', (1, 6)),
+    ('date', '2000-01-01', (0, 4)),
+    ('date', '1999-12-31', (1, 0)),
+    ('date', '2018-03-15', (2, 2)),
+    ('date', '2024-02-29', (3, 2)),
+])
+def test_partition_scheme_hash_known_answers(column_type, value, remainders):
+    assert tuple(
+        PartitionScheme('k', 'hash', modulus, column_type=column_type).route(
+            value) for modulus in (4, 7)) == remainders
+
+
+def test_create_table_with_columns_fast_load_keeps_constraints(tmpdir):
+    path = tmpdir.join('file.csv')
+    path.write('id,name\n1,a\n')
+    operator = CreateTableWithColumns(task_id='create', fast_load=True)
+    operator.sql = ['DROP TABLE IF EXISTS t;', 'CREATE TABLE t (id TEXT);']
+    conn = Mock()
+    cur = conn.cursor.return_value
+    cur.fetchall.side_effect = [
+        [('CREATE INDEX t_name_idx ON t USING btree (name)',)],
+        [('t_pkey', 'PRIMARY KEY (id)')],
+    ]
+    operator.hook = Mock()
+    operator.hook.get_conn.return_value = conn
+
+    with patch.object(sql.Composed, 'as_string',
+                      lambda self, context: render(self)):
+        operator.execute({'params': {'csv_file': str(path),
+                                     'table_name': 't'}})
+
+    statements = [c[0][0] for c in cur.execute.call_args_list]
+    assert statements[2:6] == [
+        'DROP TABLE IF EXISTS t;',
+        'CREATE UNLOGGED TABLE t (id TEXT);',
+        'CREATE INDEX t_name_idx ON t USING btree (name)',
+        'ALTER TABLE t ADD CONSTRAINT "t_pkey" PRIMARY KEY (id)',
+    ]
+    assert 'conindid' in statements[0]  # constraint indexes are skipped
+    conn.commit.assert_called_once_with()
+
+
+@pytest.mark.parametrize('csv_file', ['ftp://ftp/file.csv', 'file.csv.gz'])
+def test_create_table_with_columns_fast_load_needs_local_file(csv_file):
+    operator = CreateTableWithColumns(task_id='create', fast_load=True)
+    with pytest.raises(AirflowException):
+        operator.execute({'params': {'csv_file': csv_file,
+                                     'table_name': 't'}})
+
+
+def test_create_table_with_columns_uses_sniffed_delimiter(tmpdir):
+    path = tmpdir.join('file.csv')
+    path.write('id;name;created\n1;a;2020-01-01\n2;b;2020-01-02\n')
+    operator = CreateTableWithColumns(task_id='create', infer_types=True)
+
+    assert operator._read_columns(str(path)) == [
+        ('id', 'INTEGER'), ('name', 'TEXT'), ('created', 'DATE')]
+
+
+def test_create_table_with_columns_fast_load_uses_sniffed_delimiter(tmpdir):
+    path = tmpdir.join('file.csv')
+    path.write('id;name\n1;a\n')
+    operator = CreateTableWithColumns(task_id='create', fast_load=True)
+    operator.sql = ['DROP TABLE IF EXISTS t;', 'CREATE TABLE t (id TEXT);']
+    conn = Mock()
+    conn.cursor.return_value.fetchall.return_value = []
+    operator.hook = Mock()
+    operator.hook.get_conn.return_value = conn
+
+    with patch.object(sql.Composed, 'as_string',
+                      lambda self, context: render(self)):
+        operator.execute({'params': {'csv_file': str(path),
+                                     'table_name': 't'}})
+
+    copy_sql = conn.cursor.return_value.copy_expert.call_args[0][0]
+    assert "DELIMITER ';', QUOTE '\"', ENCODING 'UTF8'" in copy_sql
+
+
+def test_create_table_with_columns_fast_load_uses_extra_encoding(tmpdir):
+    path = tmpdir.join('file.csv')
+    path.write_binary(u'id,n\xe1zev\n1,\xe1\n'.encode('latin1'))
+    operator = CreateTableWithColumns(task_id='create', fast_load=True)
+    operator.sql = ['DROP TABLE IF EXISTS t;', 'CREATE TABLE t (id TEXT);']
+    conn = Mock()
+    conn.cursor.return_value.fetchall.return_value = []
+    operator.hook = Mock()
+    operator.hook.get_conn.return_value = conn
+
+    with patch.object(sql.Composed, 'as_string',
+                      lambda self, context: render(self)):
+        operator.execute({'params': {'csv_file': str(path),
+                                     'table_name': 't',
+                                     'extra': '-e latin1'}})
+
+    copy_sql = conn.cursor.return_value.copy_expert.call_args[0][0]
+    assert copy_sql.startswith(u'COPY t (id, n\xe1zev) FROM STDIN')
+    assert "ENCODING 'LATIN1'" in copy_sql
+
+
+def test_create_table_with_columns_empty_file(tmpdir):
+    path = tmpdir.join('empty.csv')
+    path.write('')
+    for read in [CreateTableWithColumns._get_table_columns,
+                 CreateTableWithColumns._infer_column_types]:
+        with pytest.raises(AirflowException) as e:
+            read(str(path))
+        assert str(path) in str(e.value)
+
+
+def test_create_table_with_columns_column_count_mismatch(tmpdir):
+    path = tmpdir.join('file.csv')
+    path.write('id,name\n1,a\n')
+    operator = CreateTableWithColumns(task_id='create', infer_types=True)
+
+    with patch.object(CreateTableWithColumns, '_infer_column_types',
+                      return_value=['INTEGER']):
+        with pytest.raises(AirflowException):
+            operator._read_columns(str(path))
+
+
+def test_create_tables_with_columns(tmpdir):
+    tmpdir.join('Orders.csv').write('id;total\n1;2.5\n')
+    with gzip.open(str(tmpdir.join('users.csv.gz')), 'wb') as f:
+        f.write(b'id,name\n1,a\n')
+    operator = CreateTablesWithColumns(task_id='create', infer_types=True)
+
+    operator.pre_execute({'params': {'csv_files': str(tmpdir),
+                                     'table_prefix': 'raw_'}})
+
+    assert operator.table_columns == {
+        'raw_orders': ['id', 'total'], 'raw_users': ['id', 'name']}
+    assert operator.sql == [
+        'DROP TABLE IF EXISTS raw_orders;',
+        'CREATE TABLE raw_orders (id INTEGER, total NUMERIC);',
+        'DROP TABLE IF EXISTS raw_users;',
+        'CREATE TABLE raw_users (id INTEGER, name TEXT);',
+    ]
+
+
+def test_create_tables_with_columns_no_files(tmpdir):
+    operator = CreateTablesWithColumns(task_id='create')
+    with pytest.raises(AirflowException) as e:
+        operator.pre_execute({'params': {'csv_files': str(tmpdir)}})
+    assert str(tmpdir) in str(e.value)
+
+
+def test_create_tables_with_columns_duplicate_tables(tmpdir):
+    tmpdir.join('a.csv').write('id\n1\n')
+    with gzip.open(str(tmpdir.join('a.csv.gz')), 'wb') as f:
+        f.write(b'id\n1\n')
+    operator = CreateTablesWithColumns(task_id='create')
+    with pytest.raises(AirflowException):
+        operator.pre_execute({'params': {'csv_files': str(tmpdir)}})
+
+
+def test_create_tables_with_columns_invalid_table_name(tmpdir):
+    tmpdir.join('2018-orders.csv').write('id\n1\n')
+    operator = CreateTablesWithColumns(task_id='create')
+    with pytest.raises(AirflowException) as e:
+        operator.pre_execute({'params': {'csv_files': str(tmpdir)}})
+    assert '2018-orders.csv' in str(e.value)
+
+    operator.pre_execute({'params': {'csv_files': str(tmpdir),
+                                     'table_prefix': 'raw.t'}})
+    assert operator.sql[0] == 'DROP TABLE IF EXISTS raw.t2018_orders;'
+
+
+def test_create_tables_with_columns_rejects_fast_load():
+    with pytest.raises(AirflowException):
+        CreateTablesWithColumns(task_id='create', fast_load=True)
+
+
+def run_copy_table(source_copy, copy_expert=None, get_conn=None):
+    """Copy table t by CopyTable with mocked hooks, return the target
+    connection, whether both pipe ends got closed and the error."""
+    source, target = Mock(), Mock()
+    source.copy.side_effect = source_copy
+    conn = target.get_conn.return_value
+    conn.cursor.return_value.copy_expert.side_effect = copy_expert
+    if get_conn is not None:
+        target.get_conn.side_effect = get_conn
+    hooks = {'source': source, 'target': target}
+    pipes = []
+    real_pipe = os.pipe
+
+    def pipe():
+        pipes.extend(real_pipe())
+        return pipes[-2:]
+
+    def is_closed(fd):
+        try:
+            os.fstat(fd)
+        except OSError:
+            return True
+        return False
+
+    operator = CopyTable(task_id='copy', tables=['t'], truncate=True,
+                         source_conn_id='source', target_conn_id='target')
+    error = None
+    with patch('airflow_plugins.operators.db.PostgresHook',
+               side_effect=lambda postgres_conn_id, database:
+               hooks[postgres_conn_id]), \
+            patch.object(os, 'pipe', pipe), \
+            patch.object(sql.Composed, 'as_string',
+                         lambda self, context: render(self)):
+        try:
+            operator._copy_table('t', 't')
+        except ValueError as e:
+            error = e
+    return conn, all(is_closed(fd) for fd in pipes), error
+
+
+def test_copy_table():
+    def copy_expert(statement, reader, size):
+        assert reader.read() == b'data'
+
+    conn, closed, error = run_copy_table(
+        lambda statement, writer: writer.write(b'data'), copy_expert)
+    assert error is None and closed
+    cur = conn.cursor.return_value
+    assert render(cur.execute.call_args[0][0]) == 'TRUNCATE "t"'
+    assert cur.copy_expert.call_args[0][0] == \
+        'COPY "t" FROM STDIN (FORMAT binary)'
+    conn.commit.assert_called_once_with()
+
+
+def test_copy_table_producer_failure():
+    def source_copy(statement, writer):
+        writer.write(b'partial')
+        raise ValueError('source failed')
+
+    def copy_expert(statement, reader, size):
+        reader.read()
+
+    conn, closed, error = run_copy_table(source_copy, copy_expert)
+    assert str(error) == 'source failed' and closed
+    conn.commit.assert_not_called()
+    conn.rollback.assert_called_once_with()
+
+
+def test_copy_table_consumer_failure():
+    def source_copy(statement, writer):
+        for _ in range(1024):  # more than the pipe buffer
+            writer.write(b'x' * 1024)
+
+    def copy_expert(statement, reader, size):
+        raise ValueError('target failed')
+
+    conn, closed, error = run_copy_table(source_copy, copy_expert)
+    assert str(error) == 'target failed' and closed
+    conn.commit.assert_not_called()
+    conn.rollback.assert_called_once_with()
+
+
+def test_copy_table_connection_failure():
+    conn, closed, error = run_copy_table(
+        Mock(), get_conn=ValueError('no connection'))
+    assert str(error) == 'no connection' and closed
@@ -0,0 +1,68 @@
+from airflow_plugins.csv_stats import (
+    ColumnStats,
+    HyperLogLog,
+    KLL,
+    collect_stats,
+    collect_stats_parallel
+)
+from airflow_plugins.operators.csv import SplitCSVtoDB
+
+
+def test_hyperloglog_count():
+    hll = HyperLogLog()
+    hll.update(str(i) for i in range(50000))
+    other = HyperLogLog()
+    other.update(str(i) for i in range(25000, 75000))
+    hll.merge(other)
+    assert abs(hll.count() - 75000) < 75000 * 0.03
+
+
+def test_kll_quantiles():
+    kll = KLL()
+    kll.update(range(0, 100000, 2))
+    other = KLL()
+    other.update(range(1, 100000, 2))
+    kll.merge(other)
+    assert kll.size < 1000
+    for fraction, value in zip([0.1, 0.5, 0.9],
+                               kll.quantiles([0.1, 0.5, 0.9])):
+        assert abs(value - fraction * 100000) < 2000
+
+
+def test_collect_stats(tmpdir):
+    path = tmpdir.join('file.csv')
+    rows = ['id,name,score'] + [
+        '{},"name\n{}",{}'.format(i, i % 100, '' if i % 10 else 'NA')
+        for i in range(1, 2001)]
+    path.write('\n'.join(rows) + '\n')
+
+    columns = collect_stats(str(path), chunk_size=300)
+    header_end, ranges = SplitCSVtoDB._split_ranges(str(path), 4)
+    parallel = collect_stats_parallel(str(path), ranges,
+                                      ['id', 'name', 'score'], 2)
+
+    for stats in [columns, parallel]:
+        result = [column.result() for column in stats]
+        assert result[0]['type'] == 'Number'
+        assert (result[0]['min'], result[0]['max']) == (1, 2000)
+        assert result[0]['mean'] == 1000.5
+        assert result[0]['nulls'] == 0
+        assert abs(result[0]['quantiles']['0.5'] - 1000) < 50
+        assert result[1]['type'] == 'Text'
+        assert result[1]['distinct'] == 100
+        assert result[1]['min'] == 'name\n0'
+        assert result[2]['nulls'] == 2000
+        assert result[2]['count'] == 2000
+
+
+def test_column_stats_strict_numbers():
+    for values in [['1', 'nan'], ['1', 'inf'], ['1_000'], ['0x10']]:
+        column = ColumnStats('value')
+        column.update(values)
+        assert column.result()['type'] == 'Text'
+
+    column = ColumnStats('value')
+    column.update(['-1', ' 2.5 ', '.5', '1e3'])
+    result = column.result()
+    assert result['type'] == 'Number'
+    assert (result['min'], result['max']) == (-1, 1000)
@@ -0,0 +1,12 @@
+from psycopg2 import sql
+
+
+def render(composable):
+    """Render psycopg2.sql objects without a connection."""
+    if isinstance(composable, sql.Composed):
+        return ''.join(render(part) for part in composable.seq)
+    if isinstance(composable, sql.SQL):
+        return composable.string
+    if isinstance(composable, sql.Identifier):
+        return '.'.join('"{}"'.format(s) for s in composable.strings)
+    return repr(composable.wrapped)